@@ -2,10 +2,17 @@
 from guillotina import configure
 
 
-app_settings = {"cloud_storage": "guillotina_s3storage.interfaces.IS3FileField"}
+app_settings = {
+    "cloud_storage": "guillotina_s3storage.interfaces.IS3FileField",
+    "commands": {
+        "s3-reap-uploads": "guillotina_s3storage.commands.ReapUploadsCommand",
+        "s3-benchmark": "guillotina_s3storage.commands.BenchmarkCommand",
+        "s3-migrate": "guillotina_s3storage.commands.MigrateCommand",
+    },
+}
 
 
 def includeme(root, settings):
     configure.scan("guillotina_s3storage.storage")
-    if "guillotina_rediscache" in settings.get("applications", []):
+    if "guillotina.contrib.redis" in settings.get("applications", []):
         configure.scan("guillotina_s3storage.redisdm")
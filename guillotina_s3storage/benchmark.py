@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import platform
+import time
+import uuid
+
+from guillotina import task_vars
+from guillotina.interfaces import IContainer
+from zope.interface import implementer
+
+from guillotina_s3storage.fake import FakeS3Client
+from guillotina_s3storage.pools import ClientPool
+from guillotina_s3storage.storage import CHUNK_SIZE
+from guillotina_s3storage.storage import S3FileField
+from guillotina_s3storage.storage import S3FileStorageManager
+
+
+DEFAULT_SIZES = (1024, 1024 * 1024, 16 * 1024 * 1024, 128 * 1024 * 1024)
+DEFAULT_CONCURRENCY = (1, 8)
+OPERATIONS = ("upload", "download", "exists", "copy", "delete")
+
+_UNITS = {"KB": 1024, "MB": 1024**2, "GB": 1024**3}
+
+
+def parse_size(value):
+    """
+    Parse sizes like `1KB`, `5MB` or `2GB` into bytes.
+    """
+    value = value.strip().upper()
+    for unit, factor in _UNITS.items():
+        if value.endswith(unit):
+            return int(float(value[: -len(unit)]) * factor)
+    return int(value)
+
+
+@implementer(IContainer)
+class _Container:
+    __name__ = None
+    __parent__ = None
+
+    def __init__(self, id):
+        self.id = id
+
+
+class _Resource:
+    def __init__(self, container):
+        self.__uuid__ = uuid.uuid4().hex
+        self.__name__ = self.__uuid__
+        self.__parent__ = container
+        self.file = None
+
+
+class _DataManager:
+    """
+    In-memory upload data manager, the benchmark measures S3 traffic and
+    not database writes.
+    """
+
+    def __init__(self, storage_manager):
+        self.storage_manager = storage_manager
+        self._data = {}
+
+    def get(self, name, default=None):
+        return self._data.get(name, default)
+
+    async def update(self, **kwargs):
+        self._data.update(kwargs)
+
+    async def finish(self, values=None):
+        file = self.storage_manager.file_class()
+        for key, value in (values or self._data).items():
+            setattr(file, key, value)
+        self.storage_manager.context.file = file
+        return file
+
+
+class Benchmark:
+    """
+    Measures the throughput of `S3FileStorageManager` operations with the
+    blob store `util`.
+
+    Each operation runs `concurrency` times in parallel for every file size,
+    and for every value of `pool_connections` when given. With `fake`, the
+    blob store uses an in-process `FakeS3Client` that waits `latency`
+    seconds per request and transfers at `bandwidth` bytes per second.
+    """
+
+    def __init__(
+        self,
+        util,
+        sizes=DEFAULT_SIZES,
+        concurrency=DEFAULT_CONCURRENCY,
+        pool_connections=(None,),
+        operations=OPERATIONS,
+        fake=False,
+        latency=0.0,
+        bandwidth=None,
+        container_id="s3-benchmark",
+    ):
+        self.util = util
+        self.sizes = sizes
+        self.concurrency = concurrency
+        self.pool_connections = pool_connections
+        self.operations = tuple(operations)
+        self.fake = fake
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.container = _Container(container_id)
+        self.client = None
+        self.field = S3FileField(__name__="file")
+
+    async def run(self):
+        pools = self.util._pools
+        if self.fake:
+            self.client = FakeS3Client(
+                latency=self.latency, bandwidth=self.bandwidth, keep_data=False
+            )
+            self.util._pools = {
+                name: ClientPool(self.client, pool.max_connections)
+                for name, pool in pools.items()
+            }
+        self.util._cached_buckets.clear()
+        token = task_vars.container.set(self.container)
+        results = []
+        try:
+            for connections in self.pool_connections:
+                if connections is not None:
+                    current = self.util._pools
+                    self.util._pools = {
+                        name: ClientPool(pool.client, connections)
+                        for name, pool in current.items()
+                    }
+                for size in self.sizes:
+                    for concurrency in self.concurrency:
+                        results.extend(
+                            await self._run_case(size, concurrency, connections)
+                        )
+        finally:
+            task_vars.container.reset(token)
+            self.util._pools = pools
+            self.util._cached_buckets.clear()
+        return {
+            "backend": "fake" if self.fake else "s3",
+            "python": platform.python_version(),
+            "latency": self.latency,
+            "bandwidth": self.bandwidth,
+            "results": results,
+        }
+
+    def _get_manager(self, resource):
+        return S3FileStorageManager(resource, None, self.field.bind(resource))
+
+    async def _run_case(self, size, concurrency, connections):
+        resources = [_Resource(self.container) for _ in range(concurrency)]
+        copies = [_Resource(self.container) for _ in range(concurrency)]
+        funcs = {
+            "upload": lambda idx: self._upload(resources[idx], size),
+            "download": lambda idx: self._download(resources[idx]),
+            "exists": lambda idx: self._get_manager(resources[idx]).exists(),
+            "copy": lambda idx: self._copy(resources[idx], copies[idx]),
+            "delete": lambda idx: self._delete(resources[idx], copies[idx]),
+        }
+        results = []
+        for operation, func in funcs.items():
+            # uploads and deletes also set up and clean up the other cases
+            if operation not in self.operations + ("upload", "delete"):
+                continue
+            start = time.monotonic()
+            await asyncio.gather(*[func(idx) for idx in range(concurrency)])
+            seconds = time.monotonic() - start
+            if operation not in self.operations:
+                continue
+            result = {
+                "operation": operation,
+                "size": size,
+                "concurrency": concurrency,
+                "max_pool_connections": connections,
+                "seconds": seconds,
+                "ops_per_s": concurrency / seconds if seconds else None,
+            }
+            if operation in ("upload", "download"):
+                result["mb_per_s"] = (
+                    size * concurrency / seconds / 1024**2 if seconds else None
+                )
+            results.append(result)
+        return results
+
+    async def _upload(self, resource, size):
+        manager = self._get_manager(resource)
+        dm = _DataManager(manager)
+        await dm.update(size=size)
+        await manager.start(dm)
+
+        async def generate():
+            chunk = bytes(CHUNK_SIZE)
+            remaining = size
+            while remaining > 0:
+                yield chunk[:remaining]
+                remaining -= CHUNK_SIZE
+
+        await manager.append(dm, generate(), 0)
+        await manager.finish(dm)
+        await dm.finish()
+
+    async def _download(self, resource):
+        async for _ in self._get_manager(resource).iter_data():
+            pass
+
+    async def _copy(self, resource, target):
+        target_manager = self._get_manager(target)
+        await self._get_manager(resource).copy(
+            target_manager, _DataManager(target_manager)
+        )
+
+    async def _delete(self, resource, copy):
+        await self._get_manager(resource).delete()
+        if copy.file is not None:
+            await self._get_manager(copy).delete()
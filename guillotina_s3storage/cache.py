@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Dict
+
+
+log = logging.getLogger("guillotina_s3storage")
+
+DEFAULT_MEMORY_SIZE = 64 * 1024 * 1024
+DEFAULT_MEMORY_MAX_OBJECT_SIZE = 1024 * 1024
+DEFAULT_DISK_SIZE = 1024 * 1024 * 1024
+DEFAULT_DISK_MAX_OBJECT_SIZE = 50 * 1024 * 1024
+DEFAULT_BLOCK_CACHE_SIZE = 16 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+
+class BlobCache:
+    """
+    Read-through cache of whole objects.
+
+    Objects up to `memory_max_object_size` bytes are kept in an in-memory
+    LRU of `memory_size` bytes. Larger objects, up to
+    `disk_max_object_size` bytes, are written to an LRU of `disk_size`
+    bytes under `disk_path`. Keys are `(bucket, uri, etag)` tuples.
+
+    Each cache writes its files to a directory of its own under
+    `disk_path`, so processes can share the path, and removes it on
+    `close`.
+    """
+
+    def __init__(
+        self,
+        memory_size=DEFAULT_MEMORY_SIZE,
+        memory_max_object_size=DEFAULT_MEMORY_MAX_OBJECT_SIZE,
+        disk_path=None,
+        disk_size=DEFAULT_DISK_SIZE,
+        disk_max_object_size=DEFAULT_DISK_MAX_OBJECT_SIZE,
+    ):
+        self._memory_size = memory_size
+        self._memory_max_object_size = min(memory_max_object_size, memory_size)
+        self._memory: OrderedDict = OrderedDict()
+        self._memory_used = 0
+
+        self._disk_path = disk_path
+        self._disk_dir = None
+        if disk_path is None:
+            disk_size = disk_max_object_size = 0
+        else:
+            os.makedirs(disk_path, exist_ok=True)
+            self._disk_dir = tempfile.mkdtemp(prefix="blobs-", dir=disk_path)
+        self._disk_size = disk_size
+        self._disk_max_object_size = min(disk_max_object_size, disk_size)
+        self._disk: OrderedDict = OrderedDict()
+        self._disk_used = 0
+
+        self._pending: Dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def cacheable(self, size):
+        return size is not None and size <= max(
+            self._memory_max_object_size, self._disk_max_object_size
+        )
+
+    async def get(self, key, fetch):
+        """
+        Return the cached bytes for `key`, calling `fetch()` on a miss.
+
+        Concurrent misses for the same key share a single fetch.
+        """
+        data = await self._lookup(key)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        pending = asyncio.ensure_future(self._fetch(key, fetch))
+        self._pending[key] = pending
+        pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, key, fetch):
+        data = await fetch()
+        await self._store(key, data)
+        return data
+
+    async def _lookup(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if key in self._disk:
+            self._disk.move_to_end(key)
+            loop = asyncio.get_event_loop()
+            try:
+                return await loop.run_in_executor(None, self._read_file, key)
+            except OSError:
+                log.warning("Could not read cached object", exc_info=True)
+                self._disk_used -= self._disk.pop(key, 0)
+        return None
+
+    async def _store(self, key, data):
+        size = len(data)
+        if size <= self._memory_max_object_size:
+            self._memory[key] = data
+            self._memory_used += size
+            while self._memory_used > self._memory_size:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+                self.evictions += 1
+        elif size <= self._disk_max_object_size:
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(None, self._write_file, key, data)
+            except OSError:
+                log.warning("Could not write cached object", exc_info=True)
+                return
+            self._disk[key] = size
+            self._disk_used += size
+            while self._disk_used > self._disk_size:
+                evicted, evicted_size = self._disk.popitem(last=False)
+                self._disk_used -= evicted_size
+                self._remove_file(evicted)
+                self.evictions += 1
+
+    def invalidate(self, bucket, uri):
+        """
+        Drop every cached version of `uri` in `bucket`.
+        """
+        for key in [key for key in self._memory if key[:2] == (bucket, uri)]:
+            self._memory_used -= len(self._memory.pop(key))
+        for key in [key for key in self._disk if key[:2] == (bucket, uri)]:
+            self._disk_used -= self._disk.pop(key)
+            self._remove_file(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "memory_objects": len(self._memory),
+            "memory_bytes": self._memory_used,
+            "disk_objects": len(self._disk),
+            "disk_bytes": self._disk_used,
+        }
+
+    def close(self):
+        """
+        Remove the files of the disk cache.
+        """
+        self._disk.clear()
+        self._disk_used = 0
+        if self._disk_dir is not None:
+            shutil.rmtree(self._disk_dir, ignore_errors=True)
+
+    def _get_filename(self, key):
+        return os.path.join(
+            self._disk_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        )
+
+    def _read_file(self, key):
+        with open(self._get_filename(key), "rb") as fi:
+            return fi.read()
+
+    def _write_file(self, key, data):
+        # readers never see a partly written file
+        fd, tmp = tempfile.mkstemp(dir=self._disk_dir)
+        try:
+            with os.fdopen(fd, "wb") as fi:
+                fi.write(data)
+            os.replace(tmp, self._get_filename(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._get_filename(key))
+        except OSError:
+            pass
+
+
+class BlockCache:
+    """
+    In-memory LRU of `size` bytes of object blocks, for range reads.
+
+    Blocks are `block_size` bytes aligned slices of an object, the last
+    block of an object may be shorter. Keys are
+    `(bucket, uri, etag, index)` tuples.
+    """
+
+    def __init__(self, size=DEFAULT_BLOCK_CACHE_SIZE, block_size=DEFAULT_BLOCK_SIZE):
+        self.size = size
+        self.block_size = block_size
+        self._blocks: OrderedDict = OrderedDict()
+        self._used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        data = self._blocks.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._blocks.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.size:
+            return
+        previous = self._blocks.pop(key, None)
+        if previous is not None:
+            self._used -= len(previous)
+        self._blocks[key] = data
+        self._used += len(data)
+        while self._used > self.size:
+            _, evicted = self._blocks.popitem(last=False)
+            self._used -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, bucket, uri):
+        """
+        Drop every cached block of `uri` in `bucket`.
+        """
+        for key in [key for key in self._blocks if key[:2] == (bucket, uri)]:
+            self._used -= len(self._blocks.pop(key))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "blocks": len(self._blocks),
+            "bytes": self._used,
+        }
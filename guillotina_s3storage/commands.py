@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import json
+
+from guillotina.commands import Command
+from guillotina.component import get_utility
+from guillotina.utils import get_containers
+
+from guillotina_s3storage.benchmark import DEFAULT_CONCURRENCY as BENCHMARK_CONCURRENCY
+from guillotina_s3storage.benchmark import DEFAULT_SIZES
+from guillotina_s3storage.benchmark import OPERATIONS
+from guillotina_s3storage.benchmark import Benchmark
+from guillotina_s3storage.benchmark import parse_size
+from guillotina_s3storage.interfaces import IS3BlobStore
+from guillotina_s3storage.migrate import DEFAULT_CONCURRENCY as MIGRATE_CONCURRENCY
+from guillotina_s3storage.migrate import DEFAULT_PART_SIZE
+from guillotina_s3storage.migrate import BucketMigration
+from guillotina_s3storage.reaper import DEFAULT_CONCURRENCY
+from guillotina_s3storage.reaper import DEFAULT_MAX_AGE
+from guillotina_s3storage.reaper import MultipartReaper
+
+
+class ReapUploadsCommand(Command):
+    description = "Abort incomplete S3 multipart uploads"
+
+    def get_parser(self):
+        parser = super().get_parser()
+        parser.add_argument(
+            "--max-age",
+            type=int,
+            default=DEFAULT_MAX_AGE,
+            help="Abort uploads started more than this many seconds ago",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=DEFAULT_CONCURRENCY,
+            help="Number of uploads aborted at the same time",
+        )
+        return parser
+
+    async def run(self, arguments, settings, app):
+        reaper = MultipartReaper(
+            get_utility(IS3BlobStore),
+            max_age=arguments.max_age,
+            concurrency=arguments.concurrency,
+        )
+        totals = await reaper.reap()
+        print(
+            f"Aborted {totals['aborted']} multipart uploads, "
+            f"reclaimed {totals['bytes']} bytes"
+        )
+
+
+def _split(value, convert=str):
+    return tuple(convert(item) for item in value.split(",") if item.strip())
+
+
+class BenchmarkCommand(Command):
+    description = "Benchmark S3 uploads, downloads and object operations"
+
+    def get_parser(self):
+        parser = super().get_parser()
+        parser.add_argument(
+            "--sizes",
+            default=",".join(str(size) for size in DEFAULT_SIZES),
+            help="Comma separated file sizes, e.g. 1KB,5MB,2GB",
+        )
+        parser.add_argument(
+            "--concurrency",
+            default=",".join(str(value) for value in BENCHMARK_CONCURRENCY),
+            help="Comma separated numbers of parallel operations",
+        )
+        parser.add_argument(
+            "--pool-connections",
+            default=None,
+            help="Comma separated max_pool_connections values to compare",
+        )
+        parser.add_argument(
+            "--operations",
+            default=",".join(OPERATIONS),
+            help="Comma separated operations to report",
+        )
+        parser.add_argument(
+            "--fake",
+            action="store_true",
+            help="Use an in-process S3 stand-in instead of the configured S3",
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0.0, help="Fake request latency (s)"
+        )
+        parser.add_argument(
+            "--bandwidth", type=float, default=None, help="Fake bandwidth (bytes/s)"
+        )
+        parser.add_argument(
+            "--output", default=None, help="Write the JSON results to this file"
+        )
+        return parser
+
+    async def run(self, arguments, settings, app):
+        pool_connections = (None,)
+        if arguments.pool_connections:
+            pool_connections = _split(arguments.pool_connections, int)
+        benchmark = Benchmark(
+            get_utility(IS3BlobStore),
+            sizes=_split(arguments.sizes, parse_size),
+            concurrency=_split(arguments.concurrency, int),
+            pool_connections=pool_connections,
+            operations=_split(arguments.operations),
+            fake=arguments.fake,
+            latency=arguments.latency,
+            bandwidth=arguments.bandwidth,
+        )
+        results = json.dumps(await benchmark.run(), indent=2)
+        if arguments.output:
+            with open(arguments.output, "w") as fi:
+                fi.write(results)
+        else:
+            print(results)
+
+
+class MigrateCommand(Command):
+    description = "Copy the S3 objects of a container to another bucket or endpoint"
+
+    def get_parser(self):
+        parser = super().get_parser()
+        parser.add_argument("--container", required=True, help="Container id")
+        parser.add_argument("--bucket", required=True, help="Target bucket")
+        parser.add_argument(
+            "--endpoint-url",
+            default=None,
+            help="Target endpoint, objects are copied server side when omitted",
+        )
+        parser.add_argument("--access-key", default=None, help="Target access key")
+        parser.add_argument("--secret-key", default=None, help="Target secret key")
+        parser.add_argument("--region", default=None, help="Target region")
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=MIGRATE_CONCURRENCY,
+            help="Number of objects copied at the same time",
+        )
+        parser.add_argument(
+            "--part-size",
+            default=str(DEFAULT_PART_SIZE),
+            help="Part size of streamed copies, e.g. 16MB",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default=None,
+            help="File that keeps the progress, to resume an interrupted run",
+        )
+        parser.add_argument(
+            "--no-verify",
+            action="store_true",
+            help="Do not check the sizes and checksums of the copies",
+        )
+        return parser
+
+    async def run(self, arguments, settings, app):
+        util = get_utility(IS3BlobStore)
+        target_client = None
+        if arguments.endpoint_url and arguments.endpoint_url != util._endpoint_url:
+            target_client = util._s3aiosession.create_client(
+                "s3",
+                endpoint_url=arguments.endpoint_url,
+                aws_access_key_id=arguments.access_key or util._aws_access_key,
+                aws_secret_access_key=arguments.secret_key or util._aws_secret_key,
+                region_name=arguments.region or util._region_name,
+            )
+        migration = BucketMigration(
+            util,
+            arguments.bucket,
+            target_client=target_client,
+            concurrency=arguments.concurrency,
+            part_size=parse_size(arguments.part_size),
+            checkpoint=arguments.checkpoint,
+            verify=not arguments.no_verify,
+        )
+        try:
+            async for _, _, container in get_containers():
+                if container.id == arguments.container:
+                    print(json.dumps(await migration.run(container), indent=2))
+                    return
+        finally:
+            if target_client is not None:
+                await target_client.close()
+        print(f"Container {arguments.container} not found")
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import fnmatch
+import gzip
+import logging
+import struct
+from collections import deque
+
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+
+log = logging.getLogger("guillotina_s3storage")
+
+GZIP = "gzip"
+ZSTD = "zstd"
+CODECS = (GZIP, ZSTD)
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3}
+DEFAULT_FRAME_SIZE = 1024 * 1024
+DEFAULT_CONTENT_TYPES = (
+    "text/*",
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/x-ndjson",
+    "image/svg+xml",
+)
+
+# frames are indexed by their uncompressed and compressed sizes
+_FRAME = struct.Struct(">II")
+
+
+def compress_frame(codec, level, data):
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    # no timestamp, so the same content is compressed to the same bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def decompress_frame(codec, data):
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def pack_frames(frames):
+    return b"".join(_FRAME.pack(raw, compressed) for raw, compressed in frames)
+
+
+def unpack_frames(data):
+    return [
+        _FRAME.unpack_from(data, offset) for offset in range(0, len(data), _FRAME.size)
+    ]
+
+
+def stored_size(data):
+    """
+    Size of the stored object from its packed frame index.
+    """
+    return sum(compressed for _, compressed in unpack_frames(data or b""))
+
+
+def select_frames(frames, start=0, end=None):
+    """
+    Frames that hold the uncompressed bytes `start` to `end`.
+
+    Returns the selected `(raw, compressed)` sizes, and the uncompressed
+    and stored offsets of the first selected frame.
+    """
+    raw_offset = stored_offset = 0
+    selected = []
+    first = (0, 0)
+    for raw, compressed in frames:
+        if end is not None and raw_offset >= end:
+            break
+        if raw_offset + raw > start:
+            if not selected:
+                first = (raw_offset, stored_offset)
+            selected.append((raw, compressed))
+        raw_offset += raw
+        stored_offset += compressed
+    return selected, first[0], first[1]
+
+
+async def decompress(codec, iterable, frames, skip=0, length=None):
+    """
+    Decompress the stored bytes of `frames` read from `iterable`.
+
+    The first `skip` uncompressed bytes are dropped, and at most `length`
+    bytes are yielded.
+    """
+    loop = asyncio.get_event_loop()
+    pending = deque(frames)
+    buffer = bytearray()
+    async for chunk in iterable:
+        buffer += chunk
+        while pending and len(buffer) >= pending[0][1]:
+            _, compressed = pending.popleft()
+            data = await loop.run_in_executor(
+                None, decompress_frame, codec, bytes(buffer[:compressed])
+            )
+            del buffer[:compressed]
+            if skip:
+                data, skip = data[skip:], max(0, skip - len(data))
+            if length is not None:
+                data = data[:length]
+                length -= len(data)
+            if data:
+                yield data
+            if length == 0:
+                return
+
+
+class Compression:
+    """
+    Streaming compression of uploads with a content type matching one of
+    the `content_types` patterns.
+
+    Uploads are compressed with `codec` in independent frames of
+    `frame_size` uncompressed bytes. Each frame is a complete gzip member
+    or zstd frame, so the stored object is a valid `codec` stream, and a
+    range of the file is read by decompressing only the frames that hold
+    it.
+    """
+
+    def __init__(
+        self,
+        codec=GZIP,
+        level=None,
+        frame_size=DEFAULT_FRAME_SIZE,
+        content_types=DEFAULT_CONTENT_TYPES,
+    ):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown compression codec {codec}")
+        if codec == ZSTD and zstandard is None:
+            log.warning("zstandard is not installed, compressing with gzip")
+            codec, level = GZIP, None
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.frame_size = frame_size
+        self.content_types = tuple(content_types)
+
+    def applies(self, content_type):
+        if not content_type:
+            return False
+        content_type = content_type.split(";", 1)[0].strip().lower()
+        return any(
+            fnmatch.fnmatchcase(content_type, pattern) for pattern in self.content_types
+        )
+
+    async def compress(self, iterable, frames):
+        """
+        Yield the compressed frames of the chunks of `iterable`, and append
+        the `(raw, compressed)` sizes of each frame to `frames`.
+        """
+        loop = asyncio.get_event_loop()
+        buffer = bytearray()
+
+        async def frame(data):
+            compressed = await loop.run_in_executor(
+                None, compress_frame, self.codec, self.level, data
+            )
+            frames.append((len(data), len(compressed)))
+            return compressed
+
+        async for chunk in iterable:
+            buffer += chunk
+            while len(buffer) >= self.frame_size:
+                data = bytes(buffer[: self.frame_size])
+                del buffer[: self.frame_size]
+                yield await frame(data)
+        if buffer:
+            yield await frame(bytes(buffer))
@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import hashlib
+import itertools
+import random
+import uuid
+from datetime import datetime
+from datetime import timezone
+from typing import Dict
+from typing import List
+
+import aiohttp
+import botocore
+
+
+API_NAMES = {
+    "abort_multipart_upload": "AbortMultipartUpload",
+    "complete_multipart_upload": "CompleteMultipartUpload",
+    "copy_object": "CopyObject",
+    "create_bucket": "CreateBucket",
+    "create_multipart_upload": "CreateMultipartUpload",
+    "delete_object": "DeleteObject",
+    "delete_objects": "DeleteObjects",
+    "get_object": "GetObject",
+    "head_bucket": "HeadBucket",
+    "head_object": "HeadObject",
+    "list_multipart_uploads": "ListMultipartUploads",
+    "list_objects_v2": "ListObjectsV2",
+    "list_parts": "ListParts",
+    "put_object": "PutObject",
+    "upload_part": "UploadPart",
+    "upload_part_copy": "UploadPartCopy",
+}
+
+
+# S3 rejects smaller parts, unless they are the last part of the upload
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# status of the errors that can be injected
+FAULTS = {
+    "InternalError": 500,
+    "ServiceUnavailable": 503,
+    "SlowDown": 503,
+    "ClientPayloadError": None,
+}
+
+
+def _error(operation, code, status=400, message=""):
+    return botocore.exceptions.ClientError(
+        {
+            "Error": {"Code": code, "Message": message or code},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        },
+        operation,
+    )
+
+
+def _check_md5(operation, body, content_md5):
+    """
+    ETag of `body` from its `ContentMD5`, as S3 rejects bodies that do not
+    match it.
+    """
+    if content_md5 is None:
+        return None
+    digest = base64.b64decode(content_md5)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if hashlib.md5(body).digest() != digest:
+        raise _error(operation, "BadDigest")
+    return f'"{digest.hex()}"'
+
+
+def _parse_range(value, size):
+    start, _, end = value.split("bytes=")[-1].partition("-")
+    start = int(start)
+    end = size - 1 if not end else min(int(end), size - 1)
+    return start, end
+
+
+class _Meta:
+    method_to_api_mapping = API_NAMES
+
+
+class _Exceptions:
+    """
+    Modeled exception classes, like `client.exceptions` of botocore.
+    """
+
+    def __init__(self):
+        self._classes: Dict[str, type] = {}
+
+    def from_code(self, code):
+        if code not in self._classes:
+            self._classes[code] = type(code, (botocore.exceptions.ClientError,), {})
+        return self._classes[code]
+
+
+class _Blob:
+    """
+    Content of an object or part. Only the size is kept when the client
+    does not keep data, and reads return zeros.
+    """
+
+    def __init__(self, data, keep_data, etag=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.size = len(data)
+        self.data = bytes(data) if keep_data else None
+        if etag is None:
+            if keep_data:
+                etag = f'"{hashlib.md5(self.data).hexdigest()}"'
+            else:
+                etag = f'"{uuid.uuid4().hex}"'
+        self.etag = etag
+
+    def read(self, start, end):
+        if self.data is None:
+            return bytes(end - start)
+        return self.data[start:end]
+
+
+class FakeBody:
+    def __init__(self, blob, start, end, fail=False):
+        self._blob = blob
+        self._pos = start
+        self._end = end
+        self._fail = fail
+
+    async def read(self, amt=None):
+        if self._fail:
+            raise aiohttp.ClientPayloadError("Response payload is not completed")
+        if amt is None:
+            amt = self._end - self._pos
+        end = min(self._end, self._pos + amt)
+        data = self._blob.read(self._pos, end)
+        self._pos = end
+        await asyncio.sleep(0)
+        return data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeS3Client:
+    """
+    In-process stand-in for the subset of the S3 API used by this package.
+
+    Each request waits `latency` seconds, plus the time to transfer its
+    payload at `bandwidth` bytes per second when set. With `keep_data`
+    False only the size of objects is kept, downloads return zeros and
+    ETags are random, so multi GB objects can be used for benchmarks.
+
+    Requests fail with a 500 `InternalError` with probability
+    `error_rate`, are throttled with a 503 `SlowDown` with probability
+    `throttle_rate`, and downloads fail with a `ClientPayloadError` while
+    reading the body with probability `payload_error_rate`. Pass `seed`
+    for reproducible failures, or use `inject_fault` to fail specific
+    calls.
+    """
+
+    meta = _Meta()
+    exceptions = _Exceptions()
+
+    def __init__(
+        self,
+        latency=0.0,
+        bandwidth=None,
+        keep_data=True,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        payload_error_rate=0.0,
+        seed=None,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.keep_data = keep_data
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.payload_error_rate = payload_error_rate
+        self.buckets: Dict[str, Dict[str, dict]] = {}
+        self.uploads: Dict[str, dict] = {}
+        self._upload_ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._faults: Dict[str, List[str]] = {}
+
+    def inject_fault(self, operation, code="InternalError", times=1):
+        """
+        Fail the next `times` calls of `operation`, a method name like
+        `get_object`, with the error `code` of `FAULTS`.
+        """
+        self._faults.setdefault(API_NAMES[operation], []).extend([code] * times)
+
+    def _get_fault(self, operation):
+        queued = self._faults.get(operation)
+        if queued:
+            return queued.pop(0)
+        value = self._random.random()
+        if value < self.error_rate:
+            return "InternalError"
+        value -= self.error_rate
+        if value < self.throttle_rate:
+            return "SlowDown"
+        value -= self.throttle_rate
+        if operation == "GetObject" and value < self.payload_error_rate:
+            return "ClientPayloadError"
+        return None
+
+    async def _request(self, operation, size=0):
+        """
+        Wait for the simulated transfer of a request and return the fault
+        to raise while reading the response body, if any.
+        """
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        await asyncio.sleep(delay)
+        fault = self._get_fault(operation)
+        if fault == "ClientPayloadError":
+            if operation == "GetObject":
+                return fault
+            raise aiohttp.ClientPayloadError("Response payload is not completed")
+        if fault is not None:
+            raise _error(operation, fault, FAULTS[fault])
+        return None
+
+    def _get_bucket(self, operation, bucket):
+        if bucket not in self.buckets:
+            raise _error(operation, "NoSuchBucket", 404)
+        return self.buckets[bucket]
+
+    def _get_object(self, operation, bucket, key, code="NoSuchKey"):
+        objects = self._get_bucket(operation, bucket)
+        if key not in objects:
+            raise _error(operation, code, 404)
+        return objects[key]
+
+    def _get_upload(self, operation, upload_id):
+        if upload_id not in self.uploads:
+            raise _error(operation, "NoSuchUpload", 404)
+        return self.uploads[upload_id]
+
+    def _store(self, bucket, key, blob, content_type=None):
+        self.buckets[bucket][key] = {
+            "blob": blob,
+            "content_type": content_type or "binary/octet-stream",
+            "last_modified": datetime.now(timezone.utc),
+        }
+
+    async def head_bucket(self, Bucket):
+        await self._request("HeadBucket")
+        if Bucket not in self.buckets:
+            raise _error("HeadBucket", "404", 404)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    async def create_bucket(self, Bucket, **kwargs):
+        await self._request("CreateBucket")
+        if Bucket in self.buckets:
+            raise _error("CreateBucket", "BucketAlreadyOwnedByYou", 409)
+        self.buckets[Bucket] = {}
+        return {"Location": f"/{Bucket}"}
+
+    async def put_object(
+        self, Bucket, Key, Body=b"", ContentType=None, ContentMD5=None, **kwargs
+    ):
+        self._get_bucket("PutObject", Bucket)
+        await self._request("PutObject", len(Body))
+        blob = _Blob(Body, self.keep_data, _check_md5("PutObject", Body, ContentMD5))
+        self._store(Bucket, Key, blob, ContentType)
+        return {"ETag": blob.etag}
+
+    async def get_object(self, Bucket, Key, Range=None, **kwargs):
+        obj = self._get_object("GetObject", Bucket, Key)
+        blob = obj["blob"]
+        start, end = 0, blob.size - 1
+        response = {}
+        if Range is not None:
+            start, end = _parse_range(Range, blob.size)
+            if start >= blob.size:
+                raise _error("GetObject", "InvalidRange", 416)
+            response["ContentRange"] = f"bytes {start}-{end}/{blob.size}"
+        fault = await self._request("GetObject", end + 1 - start)
+        response.update(
+            {
+                "Body": FakeBody(blob, start, end + 1, fail=fault is not None),
+                "ContentLength": end + 1 - start,
+                "ContentType": obj["content_type"],
+                "ETag": blob.etag,
+                "LastModified": obj["last_modified"],
+            }
+        )
+        return response
+
+    async def head_object(self, Bucket, Key, **kwargs):
+        await self._request("HeadObject")
+        obj = self._get_object("HeadObject", Bucket, Key, code="404")
+        return {
+            "ContentLength": obj["blob"].size,
+            "ContentType": obj["content_type"],
+            "ETag": obj["blob"].etag,
+            "LastModified": obj["last_modified"],
+        }
+
+    async def delete_object(self, Bucket, Key, **kwargs):
+        await self._request("DeleteObject")
+        self._get_bucket("DeleteObject", Bucket).pop(Key, None)
+        return {}
+
+    async def delete_objects(self, Bucket, Delete, **kwargs):
+        await self._request("DeleteObjects")
+        objects = self._get_bucket("DeleteObjects", Bucket)
+        for item in Delete["Objects"]:
+            objects.pop(item["Key"], None)
+        if Delete.get("Quiet"):
+            return {}
+        return {"Deleted": [{"Key": item["Key"]} for item in Delete["Objects"]]}
+
+    async def copy_object(self, CopySource, Bucket, Key, **kwargs):
+        source = self._get_object("CopyObject", CopySource["Bucket"], CopySource["Key"])
+        self._get_bucket("CopyObject", Bucket)
+        await self._request("CopyObject")
+        self._store(Bucket, Key, source["blob"], source["content_type"])
+        return {"CopyObjectResult": {"ETag": source["blob"].etag}}
+
+    async def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._get_bucket("CreateMultipartUpload", Bucket)
+        await self._request("CreateMultipartUpload")
+        upload_id = str(next(self._upload_ids))
+        self.uploads[upload_id] = {
+            "Bucket": Bucket,
+            "Key": Key,
+            "Parts": {},
+            "Initiated": datetime.now(timezone.utc),
+            "ContentType": kwargs.get("ContentType"),
+        }
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    async def upload_part(
+        self, Bucket, Key, PartNumber, UploadId, Body, ContentMD5=None, **kwargs
+    ):
+        upload = self._get_upload("UploadPart", UploadId)
+        await self._request("UploadPart", len(Body))
+        blob = _Blob(Body, self.keep_data, _check_md5("UploadPart", Body, ContentMD5))
+        upload["Parts"][PartNumber] = blob
+        return {"ETag": blob.etag}
+
+    async def upload_part_copy(
+        self, CopySource, CopySourceRange, Bucket, Key, UploadId, PartNumber, **kwargs
+    ):
+        source = self._get_object(
+            "UploadPartCopy", CopySource["Bucket"], CopySource["Key"]
+        )
+        upload = self._get_upload("UploadPartCopy", UploadId)
+        await self._request("UploadPartCopy")
+        start, end = _parse_range(CopySourceRange, source["blob"].size)
+        data = source["blob"].read(start, end + 1)
+        blob = _Blob(data, self.keep_data)
+        upload["Parts"][PartNumber] = blob
+        return {"CopyPartResult": {"ETag": blob.etag}}
+
+    async def complete_multipart_upload(
+        self, Bucket, Key, UploadId, MultipartUpload, **kwargs
+    ):
+        upload = self._get_upload("CompleteMultipartUpload", UploadId)
+        await self._request("CompleteMultipartUpload")
+        blobs = []
+        for part in MultipartUpload["Parts"]:
+            blob = upload["Parts"].get(part["PartNumber"])
+            if blob is None or blob.etag != part["ETag"]:
+                raise _error("CompleteMultipartUpload", "InvalidPart")
+            blobs.append(blob)
+        if not blobs:
+            raise _error("CompleteMultipartUpload", "MalformedXML")
+        if any(blob.size < MIN_PART_SIZE for blob in blobs[:-1]):
+            raise _error("CompleteMultipartUpload", "EntityTooSmall")
+        if self.keep_data:
+            data = b"".join(blob.data for blob in blobs)
+        else:
+            data = bytes(0)
+        digest = hashlib.md5(
+            b"".join(bytes.fromhex(blob.etag.strip('"')) for blob in blobs)
+        ).hexdigest()
+        blob = _Blob(data, self.keep_data, etag=f'"{digest}-{len(blobs)}"')
+        blob.size = sum(part.size for part in blobs)
+        del self.uploads[UploadId]
+        self._store(Bucket, Key, blob, upload["ContentType"])
+        return {"Bucket": Bucket, "Key": Key, "ETag": blob.etag}
+
+    async def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        await self._request("AbortMultipartUpload")
+        self._get_upload("AbortMultipartUpload", UploadId)
+        del self.uploads[UploadId]
+        return {}
+
+    async def list_objects_v2(
+        self,
+        Bucket,
+        Prefix="",
+        Delimiter=None,
+        StartAfter=None,
+        ContinuationToken=None,
+        MaxKeys=1000,
+        **kwargs,
+    ):
+        objects = self._get_bucket("ListObjectsV2", Bucket)
+        await self._request("ListObjectsV2")
+        after = ContinuationToken or StartAfter or ""
+        contents = []
+        prefixes = []
+        truncated = False
+        for key in sorted(objects):
+            if not key.startswith(Prefix) or key <= after:
+                continue
+            if Delimiter and Delimiter in key[len(Prefix) :]:
+                common = key[: key.index(Delimiter, len(Prefix)) + len(Delimiter)]
+                if common in prefixes:
+                    continue
+                item = None
+            else:
+                common = None
+                item = key
+            if len(contents) + len(prefixes) == MaxKeys:
+                truncated = True
+                break
+            if common is not None:
+                prefixes.append(common)
+            else:
+                obj = objects[item]
+                contents.append(
+                    {
+                        "Key": item,
+                        "Size": obj["blob"].size,
+                        "ETag": obj["blob"].etag,
+                        "LastModified": obj["last_modified"],
+                    }
+                )
+            after = key
+        response = {
+            "Contents": contents,
+            "CommonPrefixes": [{"Prefix": prefix} for prefix in prefixes],
+            "KeyCount": len(contents) + len(prefixes),
+            "IsTruncated": truncated,
+        }
+        if truncated:
+            response["NextContinuationToken"] = after
+        return response
+
+    async def list_multipart_uploads(
+        self, Bucket, Prefix="", KeyMarker="", UploadIdMarker="", MaxUploads=1000
+    ):
+        await self._request("ListMultipartUploads")
+        uploads = sorted(
+            (upload["Key"], upload_id, upload)
+            for upload_id, upload in self.uploads.items()
+            if upload["Bucket"] == Bucket
+            and upload["Key"].startswith(Prefix)
+            and (upload["Key"], upload_id) > (KeyMarker, UploadIdMarker)
+        )
+        page = uploads[:MaxUploads]
+        response = {
+            "Uploads": [
+                {"Key": key, "UploadId": upload_id, "Initiated": upload["Initiated"]}
+                for key, upload_id, upload in page
+            ],
+            "IsTruncated": len(uploads) > MaxUploads,
+        }
+        if response["IsTruncated"]:
+            response["NextKeyMarker"] = page[-1][0]
+            response["NextUploadIdMarker"] = page[-1][1]
+        return response
+
+    async def list_parts(
+        self, Bucket, Key, UploadId, PartNumberMarker=0, MaxParts=1000, **kwargs
+    ):
+        upload = self._get_upload("ListParts", UploadId)
+        await self._request("ListParts")
+        numbers = sorted(n for n in upload["Parts"] if n > PartNumberMarker)
+        page = numbers[:MaxParts]
+        response = {
+            "Parts": [
+                {
+                    "PartNumber": n,
+                    "ETag": upload["Parts"][n].etag,
+                    "Size": upload["Parts"][n].size,
+                }
+                for n in page
+            ],
+            "IsTruncated": len(numbers) > MaxParts,
+        }
+        if response["IsTruncated"]:
+            response["NextPartNumberMarker"] = page[-1]
+        return response
+
+    async def close(self):
+        pass
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from collections import defaultdict
+from typing import Dict
+
+
+try:
+    import prometheus_client
+except ImportError:  # pragma: no cover
+    prometheus_client = None  # type: ignore
+
+
+log = logging.getLogger("guillotina_s3storage")
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    float("inf"),
+)
+
+_prometheus_metrics: Dict[str, object] = {}
+
+
+def _get_prometheus_metrics():
+    # collectors can only be registered once per process
+    if not _prometheus_metrics:
+        _prometheus_metrics.update(
+            {
+                "s3_request_seconds": prometheus_client.Histogram(
+                    "guillotina_s3_request_seconds",
+                    "Duration of S3 requests",
+                    ["operation"],
+                    buckets=LATENCY_BUCKETS,
+                ),
+                "s3_request_errors": prometheus_client.Counter(
+                    "guillotina_s3_request_errors_total",
+                    "Failed S3 requests",
+                    ["operation", "error"],
+                ),
+                "s3_queue_wait_seconds": prometheus_client.Histogram(
+                    "guillotina_s3_queue_wait_seconds",
+                    "Time spent waiting for an S3 connection slot",
+                    ["pool"],
+                    buckets=LATENCY_BUCKETS,
+                ),
+                "s3_in_flight": prometheus_client.Gauge(
+                    "guillotina_s3_in_flight", "S3 requests in flight"
+                ),
+                "s3_retries": prometheus_client.Counter(
+                    "guillotina_s3_retries_total",
+                    "Retried S3 calls",
+                    ["operation", "reason"],
+                ),
+                "s3_giveups": prometheus_client.Counter(
+                    "guillotina_s3_giveups_total",
+                    "S3 calls that failed after all retries",
+                    ["operation", "reason"],
+                ),
+                "s3_bytes": prometheus_client.Counter(
+                    "guillotina_s3_bytes_total",
+                    "Bytes sent to and received from S3",
+                    ["direction"],
+                ),
+            }
+        )
+    return _prometheus_metrics
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip(self.buckets, self.counts)),
+        }
+
+
+class S3Metrics:
+    """
+    Counters and histograms of the S3 traffic of a blob store.
+
+    Every observation is also passed to the configured `hooks` as
+    `hook(metric, value, **labels)`, and to Prometheus when
+    `prometheus_client` is installed and `prometheus` is enabled.
+    """
+
+    def __init__(self, hooks=(), prometheus=False):
+        self.hooks = list(hooks)
+        self.latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.queue_wait: Dict[str, Histogram] = defaultdict(Histogram)
+        self.in_flight = 0
+        self.retries: Dict[str, int] = defaultdict(int)
+        self.giveups: Dict[str, int] = defaultdict(int)
+        self.retry_reasons: Dict[str, int] = defaultdict(int)
+        self.giveup_reasons: Dict[str, int] = defaultdict(int)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._prometheus = None
+        if prometheus:
+            if prometheus_client is None:
+                log.warning("prometheus_client is not installed")
+            else:
+                self._prometheus = _get_prometheus_metrics()
+
+    def _emit(self, metric, value, **labels):
+        for hook in self.hooks:
+            try:
+                hook(metric, value, **labels)
+            except Exception:
+                log.warning(f"Error in metrics hook {hook}", exc_info=True)
+
+    def observe_request(self, operation, duration, error=None):
+        self.latency[operation].observe(duration)
+        self._emit("s3_request_seconds", duration, operation=operation, error=error)
+        if self._prometheus is not None:
+            self._prometheus["s3_request_seconds"].labels(operation).observe(duration)
+        if error is not None:
+            self.errors[operation] += 1
+            if self._prometheus is not None:
+                self._prometheus["s3_request_errors"].labels(operation, error).inc()
+
+    def observe_queue_wait(self, duration, pool="default"):
+        self.queue_wait[pool].observe(duration)
+        self._emit("s3_queue_wait_seconds", duration, pool=pool)
+        if self._prometheus is not None:
+            self._prometheus["s3_queue_wait_seconds"].labels(pool).observe(duration)
+
+    def add_in_flight(self, value):
+        self.in_flight += value
+        self._emit("s3_in_flight", self.in_flight)
+        if self._prometheus is not None:
+            self._prometheus["s3_in_flight"].inc(value)
+
+    def record_retry(self, operation, reason="error"):
+        self.retries[operation] += 1
+        self.retry_reasons[reason] += 1
+        self._emit("s3_retries", 1, operation=operation, reason=reason)
+        if self._prometheus is not None:
+            self._prometheus["s3_retries"].labels(operation, reason).inc()
+
+    def record_giveup(self, operation, reason="error"):
+        self.giveups[operation] += 1
+        self.giveup_reasons[reason] += 1
+        self._emit("s3_giveups", 1, operation=operation, reason=reason)
+        if self._prometheus is not None:
+            self._prometheus["s3_giveups"].labels(operation, reason).inc()
+
+    def add_bytes(self, sent=0, received=0):
+        self.bytes_sent += sent
+        self.bytes_received += received
+        for direction, value in (("sent", sent), ("received", received)):
+            if value:
+                self._emit("s3_bytes", value, direction=direction)
+                if self._prometheus is not None:
+                    self._prometheus["s3_bytes"].labels(direction).inc(value)
+
+    def snapshot(self):
+        return {
+            "latency": {
+                operation: histogram.snapshot()
+                for operation, histogram in self.latency.items()
+            },
+            "errors": dict(self.errors),
+            "queue_wait": {
+                pool: histogram.snapshot()
+                for pool, histogram in self.queue_wait.items()
+            },
+            "in_flight": self.in_flight,
+            "retries": dict(self.retries),
+            "giveups": dict(self.giveups),
+            "retry_reasons": dict(self.retry_reasons),
+            "giveup_reasons": dict(self.giveup_reasons),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+class InstrumentedClient:
+    """
+    Proxy of an S3 client that times every API call.
+    """
+
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self._client.meta.method_to_api_mapping:
+            return attr
+
+        async def api_call(**kwargs):
+            start = time.monotonic()
+            try:
+                response = await attr(**kwargs)
+            except Exception as ex:
+                error = getattr(ex, "response", {}).get("Error", {}).get("Code")
+                self._metrics.observe_request(
+                    name, time.monotonic() - start, error=error or type(ex).__name__
+                )
+                raise
+            self._metrics.observe_request(name, time.monotonic() - start)
+            body = kwargs.get("Body")
+            self._metrics.add_bytes(
+                sent=len(body) if isinstance(body, (bytes, bytearray)) else 0,
+                received=response.get("ContentLength", 0) if "Body" in response else 0,
+            )
+            return response
+
+        return api_call
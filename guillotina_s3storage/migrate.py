@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+import botocore
+
+from guillotina_s3storage.pools import DOWNLOAD_POOL
+from guillotina_s3storage.pools import PRIORITY_BACKGROUND
+from guillotina_s3storage.pools import UPLOAD_POOL
+from guillotina_s3storage.storage import _MD5_ETAG
+from guillotina_s3storage.storage import MAX_PARTS
+from guillotina_s3storage.storage import S3FileStorageManager
+from guillotina_s3storage.storage import _md5_hexdigest
+
+
+log = logging.getLogger("guillotina_s3storage")
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+
+
+class MigrationError(Exception):
+    pass
+
+
+class BucketMigration:
+    """
+    Copies the objects of a container bucket to `target_bucket`.
+
+    Objects are copied server side, unless a `target_client` for another
+    endpoint is given, in which case they are streamed from one endpoint
+    to the other, in parts of `part_size` bytes for larger objects. Up to
+    `concurrency` objects are copied at the same time.
+
+    With `checkpoint`, the listing cursor is saved to that JSON file after
+    each page, and an interrupted migration resumes after the last saved
+    page. A page with failed copies is not saved, and the migration stops
+    after it, so the next run copies it again. With `verify`, sizes and
+    MD5 based ETags of the copies are checked.
+    """
+
+    def __init__(
+        self,
+        util,
+        target_bucket,
+        target_client=None,
+        concurrency=DEFAULT_CONCURRENCY,
+        part_size=DEFAULT_PART_SIZE,
+        checkpoint=None,
+        verify=True,
+        page_size=1000,
+    ):
+        self.util = util
+        self.target_bucket = target_bucket
+        self.target_client = target_client
+        self.concurrency = concurrency
+        self.part_size = part_size
+        self.checkpoint = checkpoint
+        self.verify = verify
+        self.page_size = page_size
+
+    @property
+    def server_side(self):
+        return self.target_client is None
+
+    async def run(self, container):
+        """
+        Copy the objects of `container`.
+
+        Returns the number of copied objects and bytes, the keys that
+        failed and the throughput.
+        """
+        source_bucket = await self.util.get_bucket_name(container)
+        state = self._load_checkpoint(container, source_bucket)
+        if state.get("done"):
+            log.info(f"Migration of {container.id} already done")
+            return self._report(state, [], 0)
+        await self._ensure_target_bucket()
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        start = time.monotonic()
+        copied = {"objects": 0, "bytes": 0}
+        failed = []
+
+        async def copy(item):
+            async with semaphore:
+                try:
+                    await self._copy_object(source_bucket, item)
+                except Exception as ex:
+                    log.warning(f"Could not copy {item['Key']}", exc_info=True)
+                    failed.append({"key": item["Key"], "error": str(ex)})
+                    return
+            copied["objects"] += 1
+            copied["bytes"] += item["Size"]
+
+        async for page in self.util.iterate_pages(
+            container=container,
+            continuation_token=state.get("cursor"),
+            page_size=self.page_size,
+        ):
+            await asyncio.gather(*[copy(item) for item in page.items])
+            if failed:
+                break
+            state["cursor"] = page.cursor
+            state["done"] = page.cursor is None
+            state["objects"] = state.get("objects", 0) + copied["objects"]
+            state["bytes"] = state.get("bytes", 0) + copied["bytes"]
+            copied = {"objects": 0, "bytes": 0}
+            self._save_checkpoint(state)
+            log.info(
+                f"Copied {state['objects']} objects, {state['bytes']} bytes "
+                f"of {container.id}"
+            )
+        return self._report(state, failed, time.monotonic() - start)
+
+    def _report(self, state, failed, seconds):
+        mb_per_s = None
+        if seconds:
+            mb_per_s = state.get("bytes", 0) / seconds / 1024**2
+        return {
+            "objects": state.get("objects", 0),
+            "bytes": state.get("bytes", 0),
+            "failed": failed,
+            "done": bool(state.get("done")),
+            "server_side": self.server_side,
+            "seconds": seconds,
+            "mb_per_s": mb_per_s,
+        }
+
+    def _load_checkpoint(self, container, source_bucket):
+        state = {
+            "container": container.id,
+            "source_bucket": source_bucket,
+            "target_bucket": self.target_bucket,
+        }
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return state
+        with open(self.checkpoint) as fi:
+            saved = json.load(fi)
+        for name, value in state.items():
+            if saved.get(name) != value:
+                raise MigrationError(
+                    f"Checkpoint {self.checkpoint} is for {name} {saved.get(name)}"
+                )
+        return saved
+
+    def _save_checkpoint(self, state):
+        if self.checkpoint is None:
+            return
+        # replaced atomically, an interrupted write keeps the previous one
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "w") as fi:
+            json.dump(state, fi)
+        os.replace(tmp, self.checkpoint)
+
+    async def _target(self, method, **kwargs):
+        if self.target_client is not None:
+            return await getattr(self.target_client, method)(**kwargs)
+        async with self.util.s3_client(
+            pool=UPLOAD_POOL, priority=PRIORITY_BACKGROUND
+        ) as client:
+            return await getattr(client, method)(**kwargs)
+
+    async def _ensure_target_bucket(self):
+        try:
+            await self._target("head_bucket", Bucket=self.target_bucket)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] not in ("404", "NoSuchBucket"):
+                raise
+            await self._target("create_bucket", Bucket=self.target_bucket)
+
+    async def _copy_object(self, source_bucket, item):
+        if self.server_side:
+            await self._server_side_copy(source_bucket, item)
+            if self.verify:
+                await self._verify_copy(item)
+        else:
+            await self._stream_copy(source_bucket, item)
+
+    async def _server_side_copy(self, source_bucket, item):
+        source = {"Bucket": source_bucket, "Key": item["Key"]}
+        if item["Size"] > self.util._copy_multipart_threshold:
+            # the multipart copy of stored files does not depend on the file
+            manager = S3FileStorageManager(None, None, None)
+            await manager._multipart_copy(
+                source, self.target_bucket, item["Key"], item["Size"]
+            )
+            return
+        await self._target(
+            "copy_object",
+            CopySource=source,
+            Bucket=self.target_bucket,
+            Key=item["Key"],
+        )
+
+    async def _verify_copy(self, item):
+        response = await self._target(
+            "head_object", Bucket=self.target_bucket, Key=item["Key"]
+        )
+        if response["ContentLength"] != item["Size"]:
+            raise MigrationError(
+                f"Size of the copy is {response['ContentLength']}, "
+                f"expected {item['Size']}"
+            )
+        if _MD5_ETAG.fullmatch(item["ETag"]) and _MD5_ETAG.fullmatch(response["ETag"]):
+            if response["ETag"] != item["ETag"]:
+                raise MigrationError(
+                    f"ETag of the copy is {response['ETag']}, expected {item['ETag']}"
+                )
+
+    async def _read(self, source_bucket, key, start, end):
+        async with self.util.s3_client(
+            pool=DOWNLOAD_POOL, priority=PRIORITY_BACKGROUND
+        ) as client:
+            response = await client.get_object(
+                Bucket=source_bucket, Key=key, Range=f"bytes={start}-{end - 1}"
+            )
+            async with response["Body"] as stream:
+                return await stream.read()
+
+    async def _stream_copy(self, source_bucket, item):
+        key = item["Key"]
+        size = item["Size"]
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        loop = asyncio.get_event_loop()
+        digest = hashlib.md5()
+        if size <= part_size:
+            data = b""
+            if size:
+                data = await self._read(source_bucket, key, 0, size)
+            digest.update(data)
+            response = await self._target(
+                "put_object", Bucket=self.target_bucket, Key=key, Body=data
+            )
+            expected = f'"{digest.hexdigest()}"'
+        else:
+            mpu = await self._target(
+                "create_multipart_upload", Bucket=self.target_bucket, Key=key
+            )
+            parts = []
+            part_digests = []
+            try:
+                for offset in range(0, size, part_size):
+                    data = await self._read(
+                        source_bucket, key, offset, min(offset + part_size, size)
+                    )
+                    await loop.run_in_executor(None, digest.update, data)
+                    part_digests.append(
+                        bytes.fromhex(
+                            await loop.run_in_executor(None, _md5_hexdigest, data)
+                        )
+                    )
+                    part = await self._target(
+                        "upload_part",
+                        Bucket=self.target_bucket,
+                        Key=key,
+                        PartNumber=len(parts) + 1,
+                        UploadId=mpu["UploadId"],
+                        Body=data,
+                    )
+                    parts.append({"PartNumber": len(parts) + 1, "ETag": part["ETag"]})
+                response = await self._target(
+                    "complete_multipart_upload",
+                    Bucket=self.target_bucket,
+                    Key=key,
+                    UploadId=mpu["UploadId"],
+                    MultipartUpload={"Parts": parts},
+                )
+            except BaseException:
+                await self._target(
+                    "abort_multipart_upload",
+                    Bucket=self.target_bucket,
+                    Key=key,
+                    UploadId=mpu["UploadId"],
+                )
+                raise
+            composite = hashlib.md5(b"".join(part_digests)).hexdigest()
+            expected = f'"{composite}-{len(parts)}"'
+
+        if not self.verify:
+            return
+        if _MD5_ETAG.fullmatch(item["ETag"]) and (
+            item["ETag"] != f'"{digest.hexdigest()}"'
+        ):
+            raise MigrationError(f"Read {key} does not match its ETag {item['ETag']}")
+        if response.get("ETag") != expected:
+            raise MigrationError(
+                f"ETag of the copy is {response.get('ETag')}, expected {expected}"
+            )
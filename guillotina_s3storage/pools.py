@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import itertools
+from typing import List
+
+
+# lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+DEFAULT_POOL = "default"
+UPLOAD_POOL = "upload"
+DOWNLOAD_POOL = "download"
+CONTROL_POOL = "control"
+
+
+class PrioritySemaphore:
+    """
+    Semaphore that hands released slots to the waiter with the lowest
+    priority value, and in arrival order for equal priorities.
+    """
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters: List[list] = []
+        self._counter = itertools.count()
+
+    def locked(self):
+        return self._value == 0
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, [priority, next(self._counter), waiter])
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over before the cancellation
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._value += 1
+
+
+class ClientPool:
+    """
+    An S3 client and the semaphore that limits its concurrent requests.
+    """
+
+    def __init__(self, client, max_connections):
+        self.client = client
+        self.max_connections = max_connections
+        self.semaphore = PrioritySemaphore(max_connections)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+import botocore
+from guillotina._settings import app_settings
+from guillotina.component import get_adapter
+from guillotina.content import iter_schemata
+from guillotina.interfaces import ICloudFileField
+from guillotina.interfaces import IFileField
+from guillotina.interfaces import IUploadDataManager
+from guillotina.schema import get_fields
+from guillotina.utils import get_containers
+from guillotina.utils import get_object_by_uid
+
+from guillotina_s3storage.pools import CONTROL_POOL
+from guillotina_s3storage.pools import PRIORITY_BACKGROUND
+
+
+log = logging.getLogger("guillotina_s3storage")
+
+DEFAULT_MAX_AGE = 24 * 60 * 60
+DEFAULT_INTERVAL = 60 * 60
+DEFAULT_CONCURRENCY = 4
+
+
+def _get_uid(key):
+    # keys are generated as {container}{path}/{uid}::{random}
+    return key.rsplit("/", 1)[-1].split("::", 1)[0]
+
+
+def _get_upload_fields(ob):
+    """
+    Names of the fields of `ob` that can have a pending upload.
+    """
+    names = set(getattr(ob, "__uploads__", None) or {})
+    for schema in iter_schemata(ob):
+        for name, field in get_fields(schema).items():
+            if ICloudFileField.providedBy(field) or IFileField.providedBy(field):
+                names.add(name)
+    return sorted(names)
+
+
+class MultipartReaper:
+    """
+    Aborts incomplete multipart uploads that are older than `max_age`
+    seconds.
+
+    Uploads still referenced by the pending upload of their resource, with
+    activity in the last `max_age` seconds, are kept. Pending uploads are
+    looked up with the `cloud_datamanager` upload data manager, in the
+    database or in Redis. Failed requests are not retried, the uploads are
+    reaped again on the next run.
+    """
+
+    def __init__(self, util, max_age=DEFAULT_MAX_AGE, concurrency=DEFAULT_CONCURRENCY):
+        self.util = util
+        self.max_age = max_age
+        self.concurrency = concurrency
+
+    async def run(self, interval=DEFAULT_INTERVAL):
+        """
+        Reap all containers every `interval` seconds, until cancelled.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reap()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warning("Error reaping multipart uploads", exc_info=True)
+
+    async def reap(self):
+        """
+        Reap the uploads of every container.
+
+        Returns the total number of aborted uploads and reclaimed bytes.
+        """
+        totals = {"aborted": 0, "bytes": 0}
+        async for _, _, container in get_containers():
+            result = await self.reap_container(container)
+            totals["aborted"] += result["aborted"]
+            totals["bytes"] += result["bytes"]
+        log.info(
+            f"Aborted {totals['aborted']} multipart uploads, "
+            f"reclaimed {totals['bytes']} bytes"
+        )
+        return totals
+
+    async def reap_container(self, container):
+        """
+        Reap the uploads of `container`, with the container transaction
+        active to look up the upload state of resources. A container that
+        never stored a file has no bucket, and nothing to reap.
+        """
+        bucket_name = self.util._get_bucket_name(container)
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.max_age)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        result = {"aborted": 0, "bytes": 0}
+
+        async def reap_upload(upload):
+            async with semaphore:
+                try:
+                    size = await self._get_upload_size(
+                        bucket_name, upload["Key"], upload["UploadId"]
+                    )
+                    await self._abort(bucket_name, upload["Key"], upload["UploadId"])
+                except botocore.exceptions.ClientError:
+                    log.warning(
+                        f"Could not abort upload of {upload['Key']}", exc_info=True
+                    )
+                    return
+            result["aborted"] += 1
+            result["bytes"] += size
+
+        params = {"Bucket": bucket_name, "Prefix": container.id + "/"}
+        while True:
+            try:
+                page = await self._list_uploads_page(**params)
+            except botocore.exceptions.ClientError as ex:
+                if ex.response["Error"]["Code"] != "NoSuchBucket":
+                    raise
+                break
+            stale = []
+            for upload in page.get("Uploads", []):
+                if upload["Initiated"] >= cutoff:
+                    continue
+                if await self._is_live(upload["Key"], upload["UploadId"], cutoff):
+                    continue
+                stale.append(upload)
+            await asyncio.gather(*[reap_upload(upload) for upload in stale])
+            if not page.get("IsTruncated"):
+                break
+            params["KeyMarker"] = page["NextKeyMarker"]
+            params["UploadIdMarker"] = page["NextUploadIdMarker"]
+        return result
+
+    async def _is_live(self, key, upload_id, cutoff):
+        # the storage manager is only needed to load the upload state
+        from guillotina_s3storage.storage import S3FileField
+        from guillotina_s3storage.storage import S3FileStorageManager
+
+        try:
+            ob = await get_object_by_uid(_get_uid(key))
+        except KeyError:
+            return False
+        for name in _get_upload_fields(ob):
+            field = S3FileField(__name__=name).bind(ob)
+            dm = get_adapter(
+                S3FileStorageManager(ob, None, field),
+                IUploadDataManager,
+                name=app_settings.get("cloud_datamanager") or "db",
+            )
+            await dm.load()
+            mpu = dm.get("_mpu") or {}
+            if dm.get("_upload_file_id") == key and mpu.get("UploadId") == upload_id:
+                return (dm.get("last_activity") or 0) >= cutoff.timestamp()
+        return False
+
+    async def _get_upload_size(self, bucket_name, key, upload_id):
+        size = 0
+        params = {"Bucket": bucket_name, "Key": key, "UploadId": upload_id}
+        while True:
+            page = await self._list_parts_page(**params)
+            size += sum(part["Size"] for part in page.get("Parts", []))
+            if not page.get("IsTruncated"):
+                return size
+            params["PartNumberMarker"] = page["NextPartNumberMarker"]
+
+    async def _list_uploads_page(self, **kwargs):
+        async with self.util.s3_client(
+            pool=CONTROL_POOL, priority=PRIORITY_BACKGROUND
+        ) as client:
+            return await client.list_multipart_uploads(**kwargs)
+
+    async def _list_parts_page(self, **kwargs):
+        async with self.util.s3_client(
+            pool=CONTROL_POOL, priority=PRIORITY_BACKGROUND
+        ) as client:
+            return await client.list_parts(**kwargs)
+
+    async def _abort(self, bucket_name, key, upload_id):
+        async with self.util.s3_client(
+            pool=CONTROL_POOL, priority=PRIORITY_BACKGROUND
+        ) as client:
+            await client.abort_multipart_upload(
+                Bucket=bucket_name, Key=key, UploadId=upload_id
+            )
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from guillotina import configure
+from guillotina.contrib.redis.dm import RedisFileDataManager
+from guillotina.interfaces import IUploadDataManager
+from guillotina.transactions import get_transaction
+
+from guillotina_s3storage.storage import IS3FileStorageManager
+
+
+@configure.adapter(
+    for_=IS3FileStorageManager, provides=IUploadDataManager, name="redis"
+)
+class S3RedisDataManager(RedisFileDataManager):
+    """
+    Redis upload data manager that keeps the parts of multipart uploads in
+    a Redis hash of part number to ETag.
+
+    Registering parts is a single atomic `HSET`, so the size of the
+    upload state does not grow with the number of parts, and parts
+    registered on any node are seen by the next request of the upload.
+    """
+
+    def get_parts_key(self):
+        return self.get_key() + "-parts"
+
+    async def start(self):
+        await super().start()
+        redis = await self.get_redis()
+        await redis.delete(self.get_parts_key())
+
+    async def register_parts(self, parts):
+        redis = await self.get_redis()
+        key = self.get_parts_key()
+        async with redis.pool.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={part["PartNumber"]: part["ETag"] for part in parts})
+            pipe.expire(key, self._ttl)
+            await pipe.execute()
+
+    async def get_parts(self):
+        redis = await self.get_redis()
+        parts = await redis.pool.hgetall(self.get_parts_key())
+        return [
+            {"PartNumber": int(part_number), "ETag": etag.decode("utf-8")}
+            for part_number, etag in sorted(
+                parts.items(), key=lambda item: int(item[0])
+            )
+        ]
+
+    async def _save(self):
+        await super()._save()
+        redis = await self.get_redis()
+        await redis.expire(self.get_parts_key(), self._ttl)
+
+    async def finish(self, values=None):
+        val = await super().finish(values=values)
+        txn = get_transaction()
+        txn.add_after_commit_hook(self._delete_parts)
+        return val
+
+    async def _delete_parts(self):
+        redis = await self.get_redis()
+        await redis.delete(self.get_parts_key())
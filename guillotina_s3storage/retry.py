@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import inspect
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict
+
+import aiohttp
+import botocore
+
+
+THROTTLE = "throttle"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+# error codes of S3 and compatible stores asking to slow down
+THROTTLE_CODES = frozenset(
+    {
+        "SlowDown",
+        "ServiceUnavailable",
+        "Throttling",
+        "ThrottlingException",
+        "RequestLimitExceeded",
+        "RequestThrottled",
+        "TooManyRequests",
+        "TooManyRequestsException",
+        "503",
+    }
+)
+TRANSIENT_CODES = frozenset(
+    {
+        "InternalError",
+        "RequestTimeout",
+        "RequestTimeoutException",
+        "PriorRequestNotComplete",
+        "OperationAborted",
+        "BadDigest",
+        "IncompleteBody",
+        "500",
+        "502",
+        "504",
+    }
+)
+
+# other errors than client and botocore errors are retried as transient
+DEFAULT_EXCEPTIONS = (
+    botocore.exceptions.ClientError,
+    aiohttp.client_exceptions.ClientPayloadError,
+    botocore.exceptions.BotoCoreError,
+)
+
+# botocore errors of the connection or the response, other botocore
+# errors, e.g. invalid parameters or missing credentials, are raised before
+# the request is sent and fail the same way when retried
+TRANSIENT_BOTOCORE_ERRORS = tuple(
+    getattr(botocore.exceptions, name)
+    for name in (
+        "EndpointConnectionError",
+        "IncompleteReadError",
+        "HTTPClientError",
+        "ResponseStreamingError",
+    )
+    if hasattr(botocore.exceptions, name)
+)
+
+DEFAULT_MAX_TRIES = 3
+DEFAULT_BASE_DELAY = 0.1
+DEFAULT_THROTTLE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 20.0
+DEFAULT_BUDGET_RATIO = 0.1
+DEFAULT_BUDGET_MAX_TOKENS = 10.0
+
+
+def classify(exc):
+    """
+    `THROTTLE`, `TRANSIENT` or `FATAL`, for errors that can not succeed
+    when retried, e.g. access denied or missing keys.
+    """
+    if isinstance(exc, botocore.exceptions.BotoCoreError):
+        if isinstance(exc, TRANSIENT_BOTOCORE_ERRORS):
+            return TRANSIENT
+        return FATAL
+    if not isinstance(exc, botocore.exceptions.ClientError):
+        return TRANSIENT
+    code = exc.response.get("Error", {}).get("Code")
+    status = exc.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    if code in THROTTLE_CODES or status in (429, 503):
+        return THROTTLE
+    if code in TRANSIENT_CODES or (status is not None and status >= 500):
+        return TRANSIENT
+    return FATAL
+
+
+def get_retry_after(exc):
+    """
+    Seconds to wait from the `Retry-After` header of an error response.
+    """
+    if not isinstance(exc, botocore.exceptions.ClientError):
+        return None
+    headers = exc.response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryBudget:
+    """
+    Token bucket that limits retries to a share of the calls.
+
+    Each call adds `ratio` tokens, up to `max_tokens`, and each retry
+    takes one token. When a bucket keeps failing, its budget runs out and
+    calls fail at once instead of piling up retries.
+    """
+
+    def __init__(
+        self, ratio=DEFAULT_BUDGET_RATIO, max_tokens=DEFAULT_BUDGET_MAX_TOKENS
+    ):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RetryPolicy:
+    """
+    Retries of the S3 calls of a blob store.
+
+    Errors are classified by their code: fatal errors are raised at once,
+    transient errors are retried after a decorrelated jitter delay
+    starting at `base_delay` seconds, and throttling errors after a delay
+    starting at `throttle_delay` seconds, or the `Retry-After` of the
+    response when longer. Delays are capped at `max_delay`. Calls are
+    tried at most `max_tries` times, and the retries of each bucket take
+    from a shared `RetryBudget`.
+    """
+
+    def __init__(
+        self,
+        exceptions=DEFAULT_EXCEPTIONS,
+        max_tries=DEFAULT_MAX_TRIES,
+        base_delay=DEFAULT_BASE_DELAY,
+        throttle_delay=DEFAULT_THROTTLE_DELAY,
+        max_delay=DEFAULT_MAX_DELAY,
+        budget_ratio=DEFAULT_BUDGET_RATIO,
+        budget_max_tokens=DEFAULT_BUDGET_MAX_TOKENS,
+        metrics=None,
+    ):
+        self.exceptions = tuple(exceptions)
+        self.max_tries = max(1, max_tries)
+        self.base_delay = base_delay
+        self.throttle_delay = throttle_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_max_tokens = budget_max_tokens
+        self.metrics = metrics
+        self._budgets: Dict[object, RetryBudget] = {}
+
+    def get_budget(self, bucket):
+        budget = self._budgets.get(bucket)
+        if budget is None:
+            budget = self._budgets[bucket] = RetryBudget(
+                self.budget_ratio, self.budget_max_tokens
+            )
+        return budget
+
+    def get_delay(self, kind, previous, exc=None):
+        base = self.throttle_delay if kind == THROTTLE else self.base_delay
+        # decorrelated jitter, so that throttled workers spread out
+        delay = min(self.max_delay, random.uniform(base, max(base, previous * 3)))
+        retry_after = get_retry_after(exc)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    async def call(self, func, args, kwargs, bucket=None):
+        operation = func.__name__
+        budget = self.get_budget(bucket)
+        budget.deposit()
+        tries = 0
+        delay = 0.0
+        while True:
+            tries += 1
+            try:
+                return await func(*args, **kwargs)
+            except self.exceptions as exc:
+                kind = classify(exc)
+                if kind == FATAL:
+                    raise
+                if tries >= self.max_tries:
+                    self._record_giveup(operation, kind)
+                    raise
+                if not budget.withdraw():
+                    self._record_giveup(operation, "budget")
+                    raise
+                delay = self.get_delay(kind, delay, exc)
+                if self.metrics is not None:
+                    self.metrics.record_retry(operation, kind)
+            await asyncio.sleep(delay)
+
+    def _record_giveup(self, operation, reason):
+        if self.metrics is not None:
+            self.metrics.record_giveup(operation, reason)
+
+
+def _get_bucket(signature, args, kwargs):
+    # calls take the bucket as an argument, in the keyword arguments of
+    # the S3 request, or in the upload state
+    try:
+        arguments = signature.bind(*args, **kwargs).arguments
+    except TypeError:
+        return None
+    for name in ("bucket", "bucket_name"):
+        if arguments.get(name) is not None:
+            return arguments[name]
+    if "Bucket" in arguments.get("kwargs", {}):
+        return arguments["kwargs"]["Bucket"]
+    if arguments.get("dm") is not None:
+        return arguments["dm"].get("_bucket_name")
+    return None
+
+
+def retriable(get_policy):
+    """
+    Decorator that retries a coroutine function with the policy returned
+    by `get_policy()`.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await get_policy().call(
+                func, args, kwargs, bucket=_get_bucket(signature, args, kwargs)
+            )
+
+        return wrapper
+
+    return decorator
@@ -1,30 +1,68 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import base64
+import bisect
 import contextlib
+import hashlib
 import logging
+import re
+import time
+import uuid
+from collections import deque
+from functools import partial
 from typing import AsyncIterator
+from typing import Deque
+from typing import Dict
+from typing import Optional
 
 import aiobotocore
 import aiohttp
-import backoff
 import botocore
 from guillotina import configure
 from guillotina import task_vars
 from guillotina.component import get_utility
+from guillotina.component import query_utility
 from guillotina.exceptions import FileNotFoundException
 from guillotina.files import BaseCloudFile
 from guillotina.files.utils import generate_key
+from guillotina.interfaces import IContainer
 from guillotina.interfaces import IExternalFileStorageManager
 from guillotina.interfaces import IFileCleanup
+from guillotina.interfaces import IObjectRemovedEvent
 from guillotina.interfaces import IRequest
 from guillotina.interfaces import IResource
 from guillotina.response import HTTPNotFound
 from guillotina.schema import Object
+from guillotina.utils import execute
+from guillotina.utils import resolve_dotted_name
 from zope.interface import implementer
 
+from guillotina_s3storage import retry
+from guillotina_s3storage.cache import BlobCache
+from guillotina_s3storage.cache import BlockCache
+from guillotina_s3storage.compression import Compression
+from guillotina_s3storage.compression import decompress
+from guillotina_s3storage.compression import pack_frames
+from guillotina_s3storage.compression import select_frames
+from guillotina_s3storage.compression import stored_size
+from guillotina_s3storage.compression import unpack_frames
+from guillotina_s3storage.fake import FakeS3Client
 from guillotina_s3storage.interfaces import IS3BlobStore
 from guillotina_s3storage.interfaces import IS3File
 from guillotina_s3storage.interfaces import IS3FileField
+from guillotina_s3storage.metrics import InstrumentedClient
+from guillotina_s3storage.metrics import S3Metrics
+from guillotina_s3storage.pools import CONTROL_POOL
+from guillotina_s3storage.pools import DEFAULT_POOL
+from guillotina_s3storage.pools import DOWNLOAD_POOL
+from guillotina_s3storage.pools import PRIORITY_BACKGROUND
+from guillotina_s3storage.pools import PRIORITY_INTERACTIVE
+from guillotina_s3storage.pools import PRIORITY_NORMAL
+from guillotina_s3storage.pools import UPLOAD_POOL
+from guillotina_s3storage.pools import ClientPool
+from guillotina_s3storage.reaper import DEFAULT_INTERVAL
+from guillotina_s3storage.reaper import MultipartReaper
+from guillotina_s3storage.retry import RetryPolicy
 
 
 log = logging.getLogger("guillotina_s3storage")
@@ -35,19 +73,62 @@ DEFAULT_MAX_POOL_CONNECTIONS = 30
 MIN_UPLOAD_SIZE = 5 * 1024 * 1024
 CHUNK_SIZE = MIN_UPLOAD_SIZE
 MAX_RETRIES = 5
+DEFAULT_UPLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_BUCKET_CACHE_TTL = 3600
+DEFAULT_RANGE_MERGE_GAP = 64 * 1024
+DEFAULT_RANGE_CONCURRENCY = 4
+
+# S3 limits
+MAX_PARTS = 10000
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+DEFAULT_MAX_PART_SIZE = 256 * 1024 * 1024
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+
+DEFAULT_COPY_PART_SIZE = 256 * 1024 * 1024
+DEFAULT_COPY_CONCURRENCY = 4
+
+DELETE_BATCH_SIZE = 1000
+
+# part ETags are stored packed, as the MD5 digest of the part
+ETAG_SIZE = 16
+_MD5_ETAG = re.compile(r'"([0-9a-f]{32})"')
+DEFAULT_DELETE_CONCURRENCY = 4
+
+
+class S3Exception(Exception):
+    pass
+
+
+class ChecksumMismatch(S3Exception):
+    """
+    The ETag S3 returned for uploaded data does not match its MD5.
+    """
+
 
 RETRIABLE_EXCEPTIONS = (
     botocore.exceptions.ClientError,
     aiohttp.client_exceptions.ClientPayloadError,
     botocore.exceptions.BotoCoreError,
+    ChecksumMismatch,
 )
 
 
-class IS3FileStorageManager(IExternalFileStorageManager):
-    pass
+_default_retry_policy = RetryPolicy(RETRIABLE_EXCEPTIONS)
 
 
-class S3Exception(Exception):
+def _get_retry_policy():
+    util = query_utility(IS3BlobStore)
+    if util is None:
+        return _default_retry_policy
+    return util._retry_policy
+
+
+retriable = retry.retriable(_get_retry_policy)
+
+
+class IS3FileStorageManager(IExternalFileStorageManager):
     pass
 
 
@@ -60,6 +141,162 @@ def _is_uploaded_file(file):
     return file is not None and isinstance(file, S3File) and file.uri is not None
 
 
+class _PartBufferPool:
+    """
+    Bounded pool of part buffers.
+
+    `acquire` waits once `size` buffers are in use. Buffers start empty
+    and grow as data is copied into them, so memory is only taken for the
+    data received, whatever the part size.
+    """
+
+    def __init__(self, size):
+        self._free = asyncio.Semaphore(size)
+
+    async def acquire(self) -> bytearray:
+        await self._free.acquire()
+        return bytearray()
+
+    def release(self, buffer: bytearray):
+        self._free.release()
+
+
+async def _iter_parts(iterable, part_size, pool, is_last=None):
+    """
+    Coalesce the chunks of `iterable` into parts of `part_size` bytes.
+
+    Yields `(body, buffer)` tuples. Chunks that are exactly one part are
+    passed through as they are, with no buffer. Other chunks are copied
+    once into buffers from `pool`, which must be released after upload.
+
+    S3 only allows the last part of an upload to be smaller than 5 MiB.
+    Unless `is_last()` is true once `iterable` is exhausted, the shorter
+    tail is appended to the part before it instead of sent on its own,
+    so the last full part is held back until the next one is read.
+    """
+    held = None
+    buffer = None
+    async for chunk in iterable:
+        if not buffer and len(chunk) == part_size:
+            if held is not None:
+                yield held
+            held = (chunk, None)
+            continue
+        view = memoryview(chunk)
+        while view:
+            if buffer is None:
+                buffer = await pool.acquire()
+            size = min(len(view), part_size - len(buffer))
+            buffer += view[:size]
+            view = view[size:]
+            if len(buffer) == part_size:
+                if held is not None:
+                    yield held
+                held = (buffer, buffer)
+                buffer = None
+    if buffer is not None and held is not None:
+        if (
+            is_last is not None
+            and not is_last()
+            and len(held[0]) + len(buffer) <= MAX_PART_SIZE
+        ):
+            body, held_buffer = held
+            if held_buffer is None:
+                buffer[0:0] = body
+            else:
+                held_buffer += buffer
+                pool.release(buffer)
+                buffer = held_buffer
+            held = None
+    if held is not None:
+        yield held
+    if buffer is not None:
+        yield buffer, buffer
+
+
+async def _chain(chunks, iterable):
+    for chunk in chunks:
+        yield chunk
+    async for chunk in iterable:
+        yield chunk
+
+
+async def _aiter(iterable):
+    if hasattr(iterable, "__aiter__"):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+def _md5_hexdigest(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def _content_md5(hexdigest):
+    return base64.b64encode(bytes.fromhex(hexdigest)).decode("ascii")
+
+
+def _check_etag(etag, hexdigest):
+    # ETags that are not an MD5, e.g. of SSE-KMS objects, are not checked,
+    # S3 still checks the ContentMD5 of the request
+    if _MD5_ETAG.fullmatch(etag or "") and etag != f'"{hexdigest}"':
+        raise ChecksumMismatch(f"ETag {etag} does not match MD5 {hexdigest}")
+
+
+def _composite_etag(parts):
+    """
+    ETag of a multipart upload of `parts`, when the ETags of all parts
+    are an MD5.
+    """
+    digests = []
+    for part in parts:
+        match = _MD5_ETAG.fullmatch(part["ETag"])
+        if match is None:
+            return None
+        digests.append(bytes.fromhex(match.group(1)))
+    return f'"{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}"'
+
+
+def _dedup_key(uri, digest):
+    # points to the object stored with content `digest`, keys start with
+    # the container id
+    return f"{uri.split('/', 1)[0]}/_dedup/{digest}"
+
+
+def _ref_key(uri, ref):
+    # marks a file referencing the deduplicated object at `uri`
+    return f"{uri}/refs/{ref}"
+
+
+def _parse_range(value):
+    """
+    Parse a `bytes=start-end` header value into a `(start, end)` tuple
+    where `end` is exclusive or None when the range is open.
+    """
+    if value is None:
+        return 0, None
+    start, _, end = value.split("bytes=")[-1].partition("-")
+    if not end:
+        return int(start), None
+    return int(start), int(end) + 1
+
+
+def _merge_ranges(ranges, gap):
+    """
+    Merge `(start, end)` ranges that overlap or are at most `gap` bytes
+    apart. Returns the merged ranges sorted by offset.
+    """
+    merged: list = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
 @implementer(IS3FileField)
 class S3FileField(Object):
     """A NamedBlobFile field."""
@@ -84,21 +321,34 @@ class S3FileStorageManager:
         self.context = context
         self.request = request
         self.field = field
+        # content hash of an upload started by this manager, only set in
+        # dedup mode
+        self._hasher = None
 
     def should_clean(self, file):
         cleanup = IFileCleanup(self.context, None)
         return cleanup is None or cleanup.should_clean(file=file, field=self.field)
 
-    @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=3)
+    @retriable
     async def _download(self, uri, bucket, **kwargs):
         util = get_utility(IS3BlobStore)
-        if bucket is None:
-            bucket = await util.get_bucket_name()
-        async with util.s3_client() as client:
+        async with util.s3_client(
+            pool=DOWNLOAD_POOL, priority=PRIORITY_INTERACTIVE
+        ) as client:
             return await client.get_object(Bucket=bucket, Key=uri, **kwargs)
 
-    async def iter_data(self, uri=None, **kwargs):
+    async def iter_data(self, uri=None, encoded=False, **kwargs):
+        """
+        Iterate through the data of the file.
+
+        Compressed files are decompressed, unless `encoded` is set, which
+        yields the bytes as stored, see `content_encoding`. The downloads of
+        guillotina do not set it, callers sending compressed bytes must opt
+        in and set the `Content-Encoding` header themselves.
+        """
         bucket = None
+        size = None
+        etag = None
         if uri is None:
             file = self.field.query(self.field.context or self.context, None)
             if not _is_uploaded_file(file):
@@ -106,6 +356,90 @@ class S3FileStorageManager:
             else:
                 uri = file.uri
                 bucket = file._bucket_name
+                size = file.size
+                etag = getattr(file, "_etag", None)
+            if getattr(file, "_compression", None) is not None:
+                if not encoded:
+                    start, end = _parse_range(kwargs.get("Range"))
+                    async for chunk in self._iter_decompressed(file, start, end):
+                        yield chunk
+                    return
+                size = stored_size(file._frames)
+
+        async for chunk in self._iter_stored(uri, bucket, size, etag, **kwargs):
+            yield chunk
+
+    async def _iter_decompressed(self, file, start=0, end=None):
+        """
+        Decompress the frames of `file` that hold `start`-`end`.
+        """
+        frames, raw_offset, stored_start = select_frames(
+            unpack_frames(file._frames), start, end
+        )
+        if not frames:
+            return
+        stored_end = stored_start + sum(compressed for _, compressed in frames)
+        stored = self._iter_stored(
+            file.uri,
+            file._bucket_name,
+            stored_size(file._frames),
+            getattr(file, "_etag", None),
+            Range=f"bytes={stored_start}-{stored_end - 1}",
+        )
+        async for chunk in decompress(
+            file._compression,
+            stored,
+            frames,
+            skip=start - raw_offset,
+            length=None if end is None else end - start,
+        ):
+            yield chunk
+
+    def content_encoding(self):
+        """
+        Codec of a compressed file when the `Accept-Encoding` header of the
+        request accepts it, so that `iter_data(encoded=True)` can be sent
+        as is with that `Content-Encoding`. `stat` returns the stored size.
+        Not used by the downloads of guillotina, for custom views only.
+        """
+        file = self.field.query(self.field.context or self.context, None)
+        codec = getattr(file, "_compression", None)
+        if codec is None or self.request is None:
+            return None
+        accepted = self.request.headers.get("Accept-Encoding", "")
+        for value in accepted.split(","):
+            encoding, _, params = value.partition(";")
+            if encoding.strip().lower() == codec and params.strip() != "q=0":
+                return codec
+        return None
+
+    async def _iter_stored(self, uri, bucket, size, etag, **kwargs):
+        util = get_utility(IS3BlobStore)
+        if bucket is None:
+            # resolved before the retried calls, that use a retry budget
+            # per bucket
+            bucket = await util.get_bucket_name()
+        if (
+            util._cache is not None
+            and util._cache.cacheable(size)
+            and set(kwargs) <= {"Range"}
+        ):
+            data = await util._cache.get(
+                (bucket, uri, etag),
+                partial(self._read_object, uri, bucket),
+            )
+            start, end = _parse_range(kwargs.get("Range"))
+            if start or end is not None:
+                data = data[start:end]
+            if data:
+                yield data
+            return
+
+        if util._download_concurrency > 1 and set(kwargs) <= {"Range"}:
+            start, end = _parse_range(kwargs.get("Range"))
+            async for chunk in self._iter_ranges(uri, bucket, start, end):
+                yield chunk
+            return
 
         downloader = await self._download(uri, bucket, **kwargs)
 
@@ -119,6 +453,78 @@ class S3FileStorageManager:
                 yield data
                 data = await stream.read(CHUNK_SIZE)
 
+    async def _iter_ranges(self, uri, bucket, start=0, end=None):
+        """
+        Download `start`-`end` with several ranged GETs in flight.
+
+        The object size is learned from the first response. At most
+        `download_concurrency` parts are prefetched ahead of the consumer,
+        and parts are yielded in order.
+        """
+        util = get_utility(IS3BlobStore)
+        if bucket is None:
+            bucket = await util.get_bucket_name()
+        part_size = util._download_part_size
+        first_end = start + part_size
+        if end is not None:
+            first_end = min(first_end, end)
+        try:
+            first = await self._download(
+                uri, bucket, Range=f"bytes={start}-{first_end - 1}"
+            )
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] == "InvalidRange":
+                # empty object, nothing to read
+                return
+            raise
+
+        total = int(first["ContentRange"].rsplit("/", 1)[-1])
+        end = total if end is None else min(end, total)
+        ranges = (
+            (offset, min(offset + part_size, end))
+            for offset in range(first_end, end, part_size)
+        )
+        pending: Deque[asyncio.Future] = deque()
+
+        def prefetch():
+            while len(pending) < util._download_concurrency:
+                try:
+                    range_start, range_end = next(ranges)
+                except StopIteration:
+                    return
+                pending.append(
+                    asyncio.ensure_future(
+                        self._read_object(
+                            uri, bucket, Range=f"bytes={range_start}-{range_end - 1}"
+                        )
+                    )
+                )
+
+        try:
+            prefetch()
+            async with first["Body"] as stream:
+                data = await stream.read(CHUNK_SIZE)
+                while data:
+                    yield data
+                    data = await stream.read(CHUNK_SIZE)
+            while pending:
+                data = await pending.popleft()
+                prefetch()
+                yield data
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @retriable
+    async def _read_object(self, uri, bucket, **kwargs):
+        util = get_utility(IS3BlobStore)
+        async with util.s3_client(
+            pool=DOWNLOAD_POOL, priority=PRIORITY_INTERACTIVE
+        ) as client:
+            response = await client.get_object(Bucket=bucket, Key=uri, **kwargs)
+            async with response["Body"] as stream:
+                return await stream.read()
+
     async def range_supported(self) -> bool:
         return True
 
@@ -126,31 +532,218 @@ class S3FileStorageManager:
         """
         Iterate through ranges of data
         """
+        util = get_utility(IS3BlobStore)
+        if util._block_cache is not None and end - start <= util._download_part_size:
+            async for chunk in self.read_ranges([(start, end)]):
+                yield chunk
+            return
         async for chunk in self.iter_data(Range=f"bytes={start}-{end - 1}"):
             yield chunk
 
+    async def read_ranges(self, ranges, gap=None) -> AsyncIterator[bytes]:
+        """
+        Yield the bytes of each `(start, end)` range of the file, in the
+        order given, `end` being exclusive.
+
+        Ranges that overlap or are at most `gap` bytes apart are read with
+        a single GET, and the GETs run concurrently. Each merged range is
+        held in memory, this is meant for many small reads such as the
+        index lookups of archives or columnar files. With the block cache
+        enabled, whole blocks are fetched and cached, and cached blocks are
+        not read again.
+        """
+        file = self.field.query(self.field.context or self.context, None)
+        if not _is_uploaded_file(file):
+            raise FileNotFoundException("File not found")
+        if getattr(file, "_compression", None) is not None:
+            # the frames of each range are read and decompressed whole
+            for start, end in ranges:
+                yield b"".join(
+                    [chunk async for chunk in self._iter_decompressed(file, start, end)]
+                )
+            return
+        util = get_utility(IS3BlobStore)
+        if gap is None:
+            gap = util._range_merge_gap
+        uri = file.uri
+        bucket = file._bucket_name
+        if bucket is None:
+            bucket = await util.get_bucket_name()
+        ranges = [(start, end) for start, end in ranges]
+        semaphore = asyncio.Semaphore(util._range_concurrency)
+
+        async def fetch(start, end):
+            async with semaphore:
+                return await self._read_object(
+                    uri, bucket, Range=f"bytes={start}-{end - 1}"
+                )
+
+        cache = util._block_cache
+        if cache is None:
+            spans = _merge_ranges([r for r in ranges if r[1] > r[0]], gap)
+            tasks = [asyncio.ensure_future(fetch(*span)) for span in spans]
+            try:
+                for start, end in ranges:
+                    if end <= start:
+                        yield b""
+                        continue
+                    # the merged span that contains this range
+                    idx = bisect.bisect_right(spans, (start, float("inf"))) - 1
+                    data = await tasks[idx]
+                    offset = spans[idx][0]
+                    yield data[start - offset : end - offset]
+            finally:
+                for task in tasks:
+                    task.cancel()
+            return
+
+        block_size = cache.block_size
+        key = (bucket, uri, getattr(file, "_etag", None))
+        blocks = {}
+        missing = []
+        for index in sorted(
+            {
+                index
+                for start, end in ranges
+                for index in range(start // block_size, -(-end // block_size))
+            }
+        ):
+            data = cache.get(key + (index,))
+            if data is None:
+                missing.append((index * block_size, (index + 1) * block_size))
+            else:
+                blocks[index] = data
+
+        async def fetch_blocks(start, end):
+            data = await fetch(start, end)
+            for offset in range(0, len(data), block_size):
+                index = (start + offset) // block_size
+                blocks[index] = data[offset : offset + block_size]
+                cache.put(key + (index,), blocks[index])
+
+        spans = _merge_ranges(missing, gap)
+        tasks = [asyncio.ensure_future(fetch_blocks(*span)) for span in spans]
+        try:
+            for start, end in ranges:
+                if end <= start:
+                    yield b""
+                    continue
+                first = start // block_size
+                for index in range(first, -(-end // block_size)):
+                    if index not in blocks:
+                        span_start = index * block_size
+                        idx = bisect.bisect_right(spans, (span_start, float("inf")))
+                        await tasks[idx - 1]
+                data = b"".join(
+                    blocks.get(index, b"")
+                    for index in range(first, -(-end // block_size))
+                )
+                offset = first * block_size
+                yield data[start - offset : end - offset]
+        finally:
+            for task in tasks:
+                task.cancel()
+
     async def delete_upload(self, uri, bucket=None):
         util = get_utility(IS3BlobStore)
         if bucket is None:
             bucket = await util.get_bucket_name()
         if uri is not None:
             try:
-                async with util.s3_client() as client:
+                async with util.s3_client(pool=CONTROL_POOL) as client:
                     await client.delete_object(Bucket=bucket, Key=uri)
             except botocore.exceptions.ClientError:
                 log.warn("Error deleting object", exc_info=True)
+            if util._cache is not None:
+                util._cache.invalidate(bucket, uri)
+            if util._block_cache is not None:
+                util._block_cache.invalidate(bucket, uri)
         else:
             raise AttributeError("No valid uri")
 
+    async def _release(self, file):
+        """
+        Delete the stored object of `file`.
+
+        Deduplicated objects are shared, so only the reference of `file` is
+        removed, and the object is deleted with its last reference.
+        """
+        ref = getattr(file, "_dedup_ref", None)
+        if ref is None:
+            await self.delete_upload(file.uri, file._bucket_name)
+            return
+
+        util = get_utility(IS3BlobStore)
+        bucket = file._bucket_name
+        if bucket is None:
+            bucket = await util.get_bucket_name()
+        await self.delete_upload(_ref_key(file.uri, ref), bucket)
+        if await self._has_refs(bucket, file.uri):
+            return
+        pointer = _dedup_key(file.uri, file._sha256)
+        if await self._read_pointer(bucket, pointer) == file.uri:
+            await self.delete_upload(pointer, bucket)
+        # an upload of the same content may have claimed it in the meantime
+        if not await self._has_refs(bucket, file.uri):
+            await self.delete_upload(file.uri, bucket)
+
+    async def _has_refs(self, bucket, uri):
+        util = get_utility(IS3BlobStore)
+        result = await util._list_objects_page(
+            Bucket=bucket, Prefix=_ref_key(uri, ""), MaxKeys=1
+        )
+        return bool(result.get("Contents"))
+
+    async def _read_pointer(self, bucket, key):
+        try:
+            data = await self._read_object(key, bucket)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return data.decode("utf-8")
+
+    @retriable
+    async def _put_marker(self, bucket, key, body=b""):
+        util = get_utility(IS3BlobStore)
+        async with util.s3_client(pool=CONTROL_POOL) as client:
+            await client.put_object(Bucket=bucket, Key=key, Body=body)
+
+    async def _claim_duplicate(self, bucket, pointer, ref):
+        """
+        Reference the stored object that `pointer` points to, if any.
+
+        Returns the stat of the referenced object, or None.
+        """
+        uri = await self._read_pointer(bucket, pointer)
+        if uri is None:
+            return None
+        # reference first, so a concurrent delete keeps the object
+        await self._put_marker(bucket, _ref_key(uri, ref))
+        # `_release` deletes the pointer before its last check for
+        # references, if it is still there that check will see this one
+        if await self._read_pointer(bucket, pointer) != uri:
+            await self.delete_upload(_ref_key(uri, ref), bucket)
+            return None
+        stat = await self._head(uri, bucket)
+        if stat is None:
+            await self.delete_upload(_ref_key(uri, ref), bucket)
+            return None
+        stat["uri"] = uri
+        return stat
+
     async def _abort_multipart(self, dm):
+        mpu = dm.get("_mpu") or {}
+        await self._abort_upload(
+            dm.get("_bucket_name"), dm.get("_upload_file_id"), mpu.get("UploadId")
+        )
+
+    async def _abort_upload(self, bucket_name, key, upload_id):
         util = get_utility(IS3BlobStore)
         try:
-            mpu = dm.get("_mpu")
-            upload_file_id = dm.get("_upload_file_id")
-            bucket_name = dm.get("_bucket_name")
-            async with util.s3_client() as client:
+            async with util.s3_client(pool=UPLOAD_POOL) as client:
                 await client.abort_multipart_upload(
-                    Bucket=bucket_name, Key=upload_file_id, UploadId=mpu["UploadId"]
+                    Bucket=bucket_name, Key=key, UploadId=upload_id
                 )
         except Exception:
             log.warn("Could not abort multipart upload", exc_info=True)
@@ -164,105 +757,458 @@ class S3FileStorageManager:
 
         bucket_name = await util.get_bucket_name()
         upload_id = generate_key(self.context)
+        self._hasher = hashlib.sha256() if util._dedup or util._verify_uploads else None
+        codec = None
+        if (
+            util._compression is not None
+            # resumable uploads track an offset, their parts must line up
+            # with the data as sent
+            and dm.get("offset") is None
+            and util._compression.applies(dm.get("content_type"))
+        ):
+            codec = util._compression.codec
         await dm.update(
             _bucket_name=bucket_name,
             _upload_file_id=upload_id,
-            _multipart={"Parts": []},
+            _parts=b"",
             _block=1,
-            _mpu=await self._create_multipart(bucket_name, upload_id),
+            _part_size=util.get_part_size(dm.get("size")),
+            # created by append once the upload does not fit a single put
+            _mpu=None,
+            _compression=codec,
+            _frames=b"" if codec is not None else None,
         )
 
-    @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=3)
+    @retriable
     async def _create_multipart(self, bucket_name, upload_id):
         util = get_utility(IS3BlobStore)
-        async with util.s3_client() as client:
+        async with util.s3_client(pool=UPLOAD_POOL) as client:
             return await client.create_multipart_upload(
                 Bucket=bucket_name, Key=upload_id
             )
 
     async def append(self, dm, iterable, offset) -> int:
+        """
+        Upload the chunks of `iterable` as parts of the multipart upload.
+
+        Uploads that end with this call within `put_threshold` bytes are
+        sent with a single `put_object`, and the multipart upload is only
+        created when that is not the case. Chunks are coalesced into parts
+        of `_part_size` bytes using a bounded pool of buffers, and
+        up to `upload_concurrency` parts are kept in flight. Unless the
+        upload ends with this call, the last part takes the remaining
+        data, so resumable uploads can send chunks of any size from 5 MiB. Part numbers
+        are assigned in read order, so parts are registered in order once
+        they have all been uploaded.
+
+        When the request is retried after a conflict, parts already stored
+        in S3 by the previous attempt, with the same size and MD5 as the
+        resent data, are reused instead of uploaded.
+
+        With `verify_uploads`, the MD5 of each part is sent as its
+        `ContentMD5` and checked against the returned ETag. The MD5 is
+        computed on the part buffer, and the SHA-256 of the whole upload
+        on the chunks as they are read, so no extra copy of the data is
+        made.
+
+        Uploads started with a compression codec are compressed in frames
+        before they are split into parts, and the frame index is kept in
+        `_frames`. The returned size is the size of the data as sent.
+        """
+        util = get_utility(IS3BlobStore)
+        concurrency = util._upload_concurrency
+        # the part size is fixed for the whole upload when it starts
+        part_size = dm.get("_part_size") or CHUNK_SIZE
+        # a part in flight per upload task, plus the part being filled and
+        # the one held back for the tail
+        pool = _PartBufferPool(concurrency + 2)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        etags = {}
         size = 0
-        async for chunk in iterable:
-            size += len(chunk)
-            part = await self._upload_part(dm, chunk)
-            multipart = dm.get("_multipart")
-            multipart["Parts"].append(
-                {"PartNumber": dm.get("_block"), "ETag": part["ETag"]}
+        block = dm.get("_block")
+
+        loop = asyncio.get_event_loop()
+
+        frames: list = []
+
+        async def count():
+            nonlocal size
+            async for chunk in iterable:
+                size += len(chunk)
+                yield chunk
+
+        async def read():
+            source = count()
+            if dm.get("_compression") is not None:
+                source = util._compression.compress(source, frames)
+            async for chunk in source:
+                if self._hasher is not None:
+                    # hashlib releases the GIL for large chunks
+                    await loop.run_in_executor(None, self._hasher.update, chunk)
+                yield chunk
+
+        async def update_frames():
+            if frames:
+                await dm.update(
+                    _frames=(dm.get("_frames") or b"") + pack_frames(frames)
+                )
+
+        source = read()
+        stored = {}
+        if dm.get("_mpu") is not None:
+            if getattr(self.request, "_retry_attempt", 0) > 0:
+                # retried after a conflict, the upload state lost the parts
+                # stored by the previous attempt
+                stored = await self._list_stored_parts(dm, block)
+        else:
+            head = []
+            buffered = 0
+            async for chunk in source:
+                head.append(chunk)
+                buffered += len(chunk)
+                if buffered > util._put_threshold:
+                    break
+            else:
+                if self._is_last_append(dm, offset + size):
+                    body = b"".join(head)
+                    md5 = None
+                    if util._verify_uploads:
+                        md5 = await loop.run_in_executor(None, _md5_hexdigest, body)
+                    response = await self._put_object(dm, body, md5=md5)
+                    await dm.update(_etag=response["ETag"])
+                    await update_frames()
+                    return size
+                if not buffered:
+                    return size
+            source = _chain(head, source)
+            await dm.update(
+                _mpu=await self._create_multipart(
+                    dm.get("_bucket_name"), dm.get("_upload_file_id")
+                )
             )
-            await dm.update(_multipart=multipart, _block=dm.get("_block") + 1)
+
+        async def read_ahead():
+            nonlocal block
+            async for body, buffer in _iter_parts(
+                source,
+                part_size,
+                pool,
+                is_last=lambda: self._is_last_append(dm, offset + size),
+            ):
+                await queue.put((block, body, buffer))
+                block += 1
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def upload():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                part_number, body, buffer = item
+                part = stored.get(part_number)
+                md5 = etag = None
+                if util._verify_uploads or (
+                    part is not None and part["Size"] == len(body)
+                ):
+                    # hashlib releases the GIL for large buffers
+                    md5 = await loop.run_in_executor(None, _md5_hexdigest, body)
+                if part is not None and part["ETag"] == f'"{md5}"':
+                    # already stored with the same content
+                    etag = part["ETag"]
+                if etag is None:
+                    response = await self._upload_part(
+                        dm,
+                        body,
+                        part_number,
+                        md5=md5 if util._verify_uploads else None,
+                    )
+                    etag = response["ETag"]
+                etags[part_number] = etag
+                if buffer is not None:
+                    pool.release(buffer)
+
+        tasks = [asyncio.ensure_future(read_ahead())]
+        tasks.extend(asyncio.ensure_future(upload()) for _ in range(concurrency))
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        if etags:
+            await self._register_parts(
+                dm,
+                [
+                    {"PartNumber": part_number, "ETag": etags[part_number]}
+                    for part_number in sorted(etags)
+                ],
+            )
+            await dm.update(_block=block)
+        await update_frames()
         return size
 
-    @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=3)
-    async def _upload_part(self, dm, data):
+    async def _register_parts(self, dm, parts):
+        """
+        Store the ETags of uploaded `parts`.
+
+        ETags are packed in `_parts`, 16 bytes at the offset of each part
+        number, so the upload state grows by a few bytes per part. ETags
+        that are not an MD5 digest are kept in `_part_etags`.
+        """
+        if hasattr(dm, "register_parts"):
+            # the data manager stores parts on its own
+            await dm.register_parts(parts)
+        elif dm.get("_multipart") is not None:
+            # upload started before parts were packed
+            multipart = dm.get("_multipart")
+            multipart["Parts"].extend(parts)
+            await dm.update(_multipart=multipart)
+        else:
+            packed = bytearray(dm.get("_parts") or b"")
+            part_etags = dict(dm.get("_part_etags") or {})
+            for part in parts:
+                part_number = part["PartNumber"]
+                offset = (part_number - 1) * ETAG_SIZE
+                if len(packed) < offset + ETAG_SIZE:
+                    packed.extend(bytes(offset + ETAG_SIZE - len(packed)))
+                match = _MD5_ETAG.fullmatch(part["ETag"])
+                if match is not None:
+                    packed[offset : offset + ETAG_SIZE] = bytes.fromhex(match.group(1))
+                    part_etags.pop(part_number, None)
+                else:
+                    packed[offset : offset + ETAG_SIZE] = bytes(ETAG_SIZE)
+                    part_etags[part_number] = part["ETag"]
+            await dm.update(_parts=bytes(packed), _part_etags=part_etags or None)
+
+    async def _get_multipart(self, dm):
+        if hasattr(dm, "get_parts"):
+            return {"Parts": await dm.get_parts()}
+        if dm.get("_multipart") is not None:
+            return dm.get("_multipart")
+        packed = dm.get("_parts") or b""
+        part_etags = dm.get("_part_etags") or {}
+        parts = []
+        for offset in range(0, len(packed), ETAG_SIZE):
+            part_number = offset // ETAG_SIZE + 1
+            digest = packed[offset : offset + ETAG_SIZE]
+            if part_number in part_etags:
+                etag = part_etags[part_number]
+            elif any(digest):
+                etag = f'"{digest.hex()}"'
+            else:
+                # not uploaded
+                continue
+            parts.append({"PartNumber": part_number, "ETag": etag})
+        return {"Parts": parts}
+
+    async def _list_stored_parts(self, dm, first_part):
+        """
+        Parts of the multipart upload stored in S3 from `first_part` on,
+        by part number.
+        """
+        params = {
+            "Bucket": dm.get("_bucket_name"),
+            "Key": dm.get("_upload_file_id"),
+            "UploadId": dm.get("_mpu")["UploadId"],
+        }
+        if first_part > 1:
+            params["PartNumberMarker"] = first_part - 1
+        parts = {}
+        while True:
+            page = await self._list_parts_page(**params)
+            for part in page.get("Parts", []):
+                parts[part["PartNumber"]] = part
+            if not page.get("IsTruncated"):
+                return parts
+            params["PartNumberMarker"] = page["NextPartNumberMarker"]
+
+    @retriable
+    async def _list_parts_page(self, **kwargs):
+        util = get_utility(IS3BlobStore)
+        async with util.s3_client(pool=CONTROL_POOL) as client:
+            return await client.list_parts(**kwargs)
+
+    def _is_last_append(self, dm, offset):
+        size = dm.get("size")
+        if size is None:
+            # only tus uploads declare that their size comes later
+            return not dm.get("deferred_length")
+        return offset >= size
+
+    @retriable
+    async def _put_object(self, dm, data, md5=None):
+        util = get_utility(IS3BlobStore)
+        kwargs = {}
+        if md5 is not None:
+            kwargs["ContentMD5"] = _content_md5(md5)
+        async with util.s3_client(pool=UPLOAD_POOL) as client:
+            response = await client.put_object(
+                Bucket=dm.get("_bucket_name"),
+                Key=dm.get("_upload_file_id"),
+                Body=data,
+                **kwargs,
+            )
+        if md5 is not None:
+            _check_etag(response.get("ETag"), md5)
+        return response
+
+    @retriable
+    async def _upload_part(self, dm, data, part_number=None, md5=None):
+        if part_number is None:
+            part_number = dm.get("_block")
         util = get_utility(IS3BlobStore)
-        async with util.s3_client() as client:
-            return await client.upload_part(
+        kwargs = {}
+        if md5 is not None:
+            kwargs["ContentMD5"] = _content_md5(md5)
+        async with util.s3_client(pool=UPLOAD_POOL) as client:
+            response = await client.upload_part(
                 Bucket=dm.get("_bucket_name"),
                 Key=dm.get("_upload_file_id"),
-                PartNumber=dm.get("_block"),
+                PartNumber=part_number,
                 UploadId=dm.get("_mpu")["UploadId"],
                 Body=data,
+                **kwargs,
             )
+        if md5 is not None:
+            _check_etag(response.get("ETag"), md5)
+        return response
 
     async def finish(self, dm):
+        bucket = dm.get("_bucket_name")
+        uri = dm.get("_upload_file_id")
+        mpu = dm.get("_mpu")
+        # set when append stored the whole upload with a single put
+        etag = dm.get("_etag")
+        if mpu is None and etag is None:
+            # nothing was appended
+            etag = (await self._put_object(dm, b""))["ETag"]
+
+        util = get_utility(IS3BlobStore)
+        digest = ref = duplicate = None
+        if self._hasher is not None:
+            digest = self._hasher.hexdigest()
+        if digest is not None and util._dedup:
+            pointer = _dedup_key(uri, digest)
+            ref = uuid.uuid4().hex
+            duplicate = await self._claim_duplicate(bucket, pointer, ref)
+            if duplicate is not None:
+                if mpu is not None:
+                    await self._abort_multipart(dm)
+                else:
+                    await self.delete_upload(uri, bucket)
+                uri, etag = duplicate["uri"], duplicate["etag"]
+        if duplicate is None:
+            if mpu is not None:
+                etag = (await self._complete_multipart_upload(dm)).get("ETag")
+                if util._verify_uploads:
+                    await self._check_multipart_etag(dm, etag)
+            if ref is not None:
+                await self._put_marker(bucket, _ref_key(uri, ref))
+                await self._put_marker(bucket, pointer, uri.encode("utf-8"))
+        self._hasher = None
+
         file = self.field.query(self.field.context or self.context, None)
         if _is_uploaded_file(file):
-            # delete existing file
+            # delete existing file, once the new one is stored in case
+            # they share a deduplicated object
             if self.should_clean(file):
                 try:
-                    await self.delete_upload(file.uri, file._bucket_name)
+                    await self._release(file)
                 except botocore.exceptions.ClientError:
                     log.error(
                         f"Referenced key {file.uri} could not be found", exc_info=True
                     )
                     log.warn("Error deleting object", exc_info=True)
 
-        if dm.get("_mpu") is not None:
-            await self._complete_multipart_upload(dm)
+        if util._cache is not None:
+            util._cache.invalidate(bucket, dm.get("_upload_file_id"))
+        if util._block_cache is not None:
+            util._block_cache.invalidate(bucket, dm.get("_upload_file_id"))
         await dm.update(
-            uri=dm.get("_upload_file_id"),
+            uri=uri,
+            _etag=etag,
+            _sha256=digest,
+            _dedup_ref=ref,
             _multipart=None,
+            _parts=None,
+            _part_etags=None,
             _mpu=None,
             _block=None,
             _upload_file_id=None,
         )
 
-    @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=3)
+    async def _check_multipart_etag(self, dm, etag):
+        """
+        Check the ETag of a completed multipart upload against the MD5 of
+        its parts, and delete the object when they differ.
+        """
+        multipart = await self._get_multipart(dm)
+        expected = _composite_etag(multipart["Parts"])
+        if expected is None or etag is None or "-" not in etag or etag == expected:
+            return
+        await self.delete_upload(dm.get("_upload_file_id"), dm.get("_bucket_name"))
+        raise ChecksumMismatch(f"ETag {etag} does not match the parts, {expected}")
+
+    @retriable
     async def _complete_multipart_upload(self, dm):
         util = get_utility(IS3BlobStore)
         # if blocks is 0, it means the file is of zero length so we need to
         # trick it to finish a multiple part with no data.
         if dm.get("_block") == 1:
             part = await self._upload_part(dm, b"")
-            multipart = dm.get("_multipart")
-            multipart["Parts"].append(
-                {"PartNumber": dm.get("_block"), "ETag": part["ETag"]}
+            await self._register_parts(
+                dm, [{"PartNumber": dm.get("_block"), "ETag": part["ETag"]}]
             )
-            await dm.update(_multipart=multipart, _block=dm.get("_block") + 1)
-        async with util.s3_client() as client:
-            await client.complete_multipart_upload(
+            await dm.update(_block=dm.get("_block") + 1)
+        multipart = await self._get_multipart(dm)
+        async with util.s3_client(pool=UPLOAD_POOL) as client:
+            return await client.complete_multipart_upload(
                 Bucket=dm.get("_bucket_name"),
                 Key=dm.get("_upload_file_id"),
                 UploadId=dm.get("_mpu")["UploadId"],
-                MultipartUpload=dm.get("_multipart"),
+                MultipartUpload=multipart,
             )
 
     async def exists(self):
-        bucket = None
+        return await self.stat() is not None
+
+    async def stat(self):
+        """
+        Metadata of the stored object from a single HEAD request.
+
+        Returns a dict with `size`, `etag`, `content_type` and
+        `last_modified`, or None if there is no stored object.
+        """
         file = self.field.query(self.field.context or self.context, None)
         if not _is_uploaded_file(file):
-            return False
-        else:
-            uri = file.uri
-            bucket = file._bucket_name
+            return None
+        return await self._head(file.uri, file._bucket_name)
+
+    async def _head(self, uri, bucket):
+        if bucket is None:
+            bucket = await get_utility(IS3BlobStore).get_bucket_name()
+        return await self._head_object(uri, bucket)
+
+    @retriable
+    async def _head_object(self, uri, bucket):
         util = get_utility(IS3BlobStore)
         try:
-            async with util.s3_client() as client:
-                return await client.get_object(Bucket=bucket, Key=uri) is not None
+            async with util.s3_client(pool=CONTROL_POOL) as client:
+                response = await client.head_object(Bucket=bucket, Key=uri)
         except botocore.exceptions.ClientError as ex:
-            if ex.response["Error"]["Code"] == "NoSuchKey":
-                return False
+            # HEAD responses have no body, so the error code is the status
+            if ex.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
             raise
+        return {
+            "size": response["ContentLength"],
+            "etag": response["ETag"],
+            "content_type": response.get("ContentType"),
+            "last_modified": response.get("LastModified"),
+        }
 
     async def copy(self, to_storage_manager, to_dm):
         file = self.field.query(self.field.context or self.context, None)
@@ -272,26 +1218,134 @@ class S3FileStorageManager:
             )
 
         util = get_utility(IS3BlobStore)
+        bucket_name = await util.get_bucket_name()
+        if getattr(file, "_dedup_ref", None) is not None and (
+            file._bucket_name == bucket_name
+        ):
+            # deduplicated objects are shared, only add a reference
+            ref = uuid.uuid4().hex
+            await self._put_marker(bucket_name, _ref_key(file.uri, ref))
+            await to_dm.finish(
+                values={
+                    "content_type": file.content_type,
+                    "size": file.size,
+                    "uri": file.uri,
+                    "filename": file.filename or "unknown",
+                    "_bucket_name": bucket_name,
+                    "_etag": getattr(file, "_etag", None),
+                    "_sha256": file._sha256,
+                    "_dedup_ref": ref,
+                    "_compression": getattr(file, "_compression", None),
+                    "_frames": getattr(file, "_frames", None),
+                }
+            )
+            return
+
+        source = {"Bucket": file._bucket_name, "Key": file.uri}
+
+        size = file.size
+        if getattr(file, "_compression", None) is not None:
+            size = stored_size(file._frames)
+        if size is None:
+            size = (await self._head(file.uri, file._bucket_name))["size"]
 
         new_uri = generate_key(self.context)
-        async with util.s3_client() as client:
-            await client.copy_object(
-                CopySource={"Bucket": file._bucket_name, "Key": file.uri},
-                Bucket=file._bucket_name,
-                Key=new_uri,
-            )
+        if size > util._copy_multipart_threshold:
+            await self._multipart_copy(source, bucket_name, new_uri, size)
+        else:
+            async with util.s3_client(
+                pool=UPLOAD_POOL, priority=PRIORITY_BACKGROUND
+            ) as client:
+                await client.copy_object(
+                    CopySource=source, Bucket=bucket_name, Key=new_uri
+                )
         await to_dm.finish(
             values={
                 "content_type": file.content_type,
                 "size": file.size,
                 "uri": new_uri,
                 "filename": file.filename or "unknown",
+                "_bucket_name": bucket_name,
+                "_compression": getattr(file, "_compression", None),
+                "_frames": getattr(file, "_frames", None),
             }
         )
 
+    async def _multipart_copy(self, source, bucket_name, key, size):
+        """
+        Copy `source` server side with concurrent `upload_part_copy`
+        requests. The multipart upload is aborted if any part fails.
+        """
+        util = get_utility(IS3BlobStore)
+        part_size = max(util._copy_part_size, -(-size // MAX_PARTS))
+        semaphore = asyncio.Semaphore(util._copy_concurrency)
+        mpu = await self._create_multipart(bucket_name, key)
+
+        async def copy_part(part_number, start, end):
+            async with semaphore:
+                part = await self._upload_part_copy(
+                    source, bucket_name, key, mpu["UploadId"], part_number, start, end
+                )
+            return {"PartNumber": part_number, "ETag": part["CopyPartResult"]["ETag"]}
+
+        tasks = [
+            asyncio.ensure_future(
+                copy_part(idx + 1, start, min(start + part_size, size))
+            )
+            for idx, start in enumerate(range(0, size, part_size))
+        ]
+        try:
+            parts = await asyncio.gather(*tasks)
+            async with util.s3_client(
+                pool=UPLOAD_POOL, priority=PRIORITY_BACKGROUND
+            ) as client:
+                await client.complete_multipart_upload(
+                    Bucket=bucket_name,
+                    Key=key,
+                    UploadId=mpu["UploadId"],
+                    MultipartUpload={"Parts": parts},
+                )
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._abort_upload(bucket_name, key, mpu["UploadId"])
+            raise
+
+    @retriable
+    async def _upload_part_copy(
+        self, source, bucket_name, key, upload_id, part_number, start, end
+    ):
+        util = get_utility(IS3BlobStore)
+        async with util.s3_client(
+            pool=UPLOAD_POOL, priority=PRIORITY_BACKGROUND
+        ) as client:
+            return await client.upload_part_copy(
+                CopySource=source,
+                CopySourceRange=f"bytes={start}-{end - 1}",
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+            )
+
     async def delete(self):
         file = self.field.get(self.field.context or self.context)
-        await self.delete_upload(file.uri)
+        await self._release(file)
+
+
+class ListPage:
+    """
+    A page of a bucket listing.
+
+    `cursor` resumes the listing after this page, it is None on the
+    last page.
+    """
+
+    def __init__(self, items, prefixes, cursor):
+        self.items = items
+        self.prefixes = prefixes
+        self.cursor = cursor
 
 
 class S3BlobStore:
@@ -303,19 +1357,44 @@ class S3BlobStore:
             "max_pool_connections", DEFAULT_MAX_POOL_CONNECTIONS
         )
 
+        self._endpoint_url = settings.get("endpoint_url")
+        self._region_name = settings.get("region_name")
         opts = dict(
             aws_secret_access_key=self._aws_secret_key,
             aws_access_key_id=self._aws_access_key,
-            endpoint_url=settings.get("endpoint_url"),
+            endpoint_url=self._endpoint_url,
             verify=settings.get("verify_ssl"),
             use_ssl=settings.get("ssl", True),
-            region_name=settings.get("region_name"),
+            region_name=self._region_name,
             config=aiobotocore.config.AioConfig(
                 None, max_pool_connections=max_pool_connections
             ),
         )
 
-        self._s3_request_semaphore = asyncio.BoundedSemaphore(max_pool_connections)
+        self._metrics = S3Metrics(
+            hooks=[
+                resolve_dotted_name(hook) for hook in settings.get("metrics_hooks", [])
+            ],
+            prometheus=settings.get("prometheus", False),
+        )
+        self._retry_policy = RetryPolicy(
+            RETRIABLE_EXCEPTIONS, metrics=self._metrics, **settings.get("retry", {})
+        )
+        self._upload_concurrency = max(
+            1, settings.get("upload_concurrency", DEFAULT_UPLOAD_CONCURRENCY)
+        )
+        self._min_part_size = max(
+            MIN_UPLOAD_SIZE, settings.get("min_part_size", MIN_UPLOAD_SIZE)
+        )
+        self._max_part_size = min(
+            MAX_PART_SIZE, settings.get("max_part_size", DEFAULT_MAX_PART_SIZE)
+        )
+        self._download_concurrency = max(
+            1, settings.get("download_concurrency", DEFAULT_DOWNLOAD_CONCURRENCY)
+        )
+        self._download_part_size = settings.get(
+            "download_part_size", DEFAULT_DOWNLOAD_PART_SIZE
+        )
 
         if loop is None:
             loop = asyncio.get_event_loop()
@@ -323,9 +1402,79 @@ class S3BlobStore:
 
         self._s3aiosession = aiobotocore.get_session(loop=loop)
 
-        # This client is for downloads only
-        self._s3aioclient = self._s3aiosession.create_client("s3", **opts)
-        self._cached_buckets = []
+        fake = settings.get("fake", False)
+        if fake is not False:
+            # in-process S3, e.g. for tests and load simulation
+            fake_settings = fake if isinstance(fake, dict) else {}
+            self._s3aioclient = FakeS3Client(**fake_settings)
+        else:
+            self._s3aioclient = self._s3aiosession.create_client("s3", **opts)
+        self._pools = {
+            DEFAULT_POOL: ClientPool(self._s3aioclient, max_pool_connections)
+        }
+        for name, pool_settings in settings.get("pools", {}).items():
+            pool_connections = pool_settings.get(
+                "max_pool_connections", max_pool_connections
+            )
+            config = aiobotocore.config.AioConfig(
+                None,
+                max_pool_connections=pool_connections,
+                connect_timeout=pool_settings.get("connect_timeout", 60),
+                read_timeout=pool_settings.get("read_timeout", 60),
+            )
+            if fake is not False:
+                client = self._s3aioclient
+            else:
+                client = self._s3aiosession.create_client(
+                    "s3", **dict(opts, config=config)
+                )
+            self._pools[name] = ClientPool(client, pool_connections)
+        self._s3_request_semaphore = self._pools[DEFAULT_POOL].semaphore
+        # bucket name -> expiration of the existence check
+        self._cached_buckets: Dict[str, float] = {}
+        self._bucket_lookups: Dict[str, asyncio.Future] = {}
+        self._bucket_cache_ttl = settings.get(
+            "bucket_cache_ttl", DEFAULT_BUCKET_CACHE_TTL
+        )
+
+        self._copy_multipart_threshold = settings.get(
+            "copy_multipart_threshold", MAX_COPY_SIZE
+        )
+        self._copy_part_size = settings.get("copy_part_size", DEFAULT_COPY_PART_SIZE)
+        self._copy_concurrency = max(
+            1, settings.get("copy_concurrency", DEFAULT_COPY_CONCURRENCY)
+        )
+        self._cache = None
+        if settings.get("cache"):
+            self._cache = BlobCache(**settings["cache"])
+        self._block_cache = None
+        if settings.get("range_cache"):
+            self._block_cache = BlockCache(**settings["range_cache"])
+        self._range_merge_gap = settings.get("range_merge_gap", DEFAULT_RANGE_MERGE_GAP)
+        self._range_concurrency = max(
+            1, settings.get("range_concurrency", DEFAULT_RANGE_CONCURRENCY)
+        )
+        self._delete_concurrency = max(
+            1, settings.get("delete_concurrency", DEFAULT_DELETE_CONCURRENCY)
+        )
+        self._cleanup_on_container_delete = settings.get(
+            "cleanup_on_container_delete", False
+        )
+        self._dedup = settings.get("dedup", False)
+        self._verify_uploads = settings.get("verify_uploads", False)
+        self._reaper = None
+        self._reaper_interval = DEFAULT_INTERVAL
+        self._reaper_task = None
+        if settings.get("reaper"):
+            reaper_settings = dict(settings["reaper"])
+            self._reaper_interval = reaper_settings.pop("interval", DEFAULT_INTERVAL)
+            self._reaper = MultipartReaper(self, **reaper_settings)
+        self._compression = None
+        if settings.get("compression"):
+            self._compression = Compression(**settings["compression"])
+        self._put_threshold = max(
+            MIN_UPLOAD_SIZE, settings.get("put_threshold", MIN_UPLOAD_SIZE)
+        )
 
         self._bucket_name = settings["bucket"]
 
@@ -333,14 +1482,63 @@ class S3BlobStore:
             "bucket_name_format", "{container}{delimiter}{base}"
         )
 
-    @contextlib.asynccontextmanager
-    async def s3_client(self):
-        async with self._s3_request_semaphore:
-            yield self._s3aioclient
+    def cache_stats(self):
+        """
+        Hit and miss counters of the read-through cache, if enabled.
+        """
+        if self._cache is not None:
+            return self._cache.stats()
 
-    async def get_bucket_name(self):
-        container = task_vars.container.get()
+    def range_cache_stats(self):
+        """
+        Hit and miss counters of the block cache of range reads, if enabled.
+        """
+        if self._block_cache is not None:
+            return self._block_cache.stats()
 
+    def get_part_size(self, size=None):
+        """
+        Part size for a multipart upload of `size` bytes.
+
+        The smallest size within the configured bounds that fits the whole
+        upload in `MAX_PARTS` parts, rounded up to a whole MiB.
+        """
+        part_size = self._min_part_size
+        if size:
+            part_size = max(part_size, -(-size // MAX_PARTS))
+        part_size = -(-part_size // (1024 * 1024)) * 1024 * 1024
+        return min(part_size, self._max_part_size)
+
+    def metrics_snapshot(self):
+        """
+        Latency histograms, queue wait, retries and byte counters of the
+        requests made through `s3_client`.
+        """
+        return self._metrics.snapshot()
+
+    @contextlib.asynccontextmanager
+    async def s3_client(self, pool=DEFAULT_POOL, priority=PRIORITY_NORMAL):
+        """
+        Client of the `pool` connection pool, falling back to the default
+        pool when it is not configured. Waiting requests are served by
+        `priority`, lower values first.
+        """
+        if pool not in self._pools:
+            pool = DEFAULT_POOL
+        client_pool = self._pools[pool]
+        start = time.monotonic()
+        await client_pool.semaphore.acquire(priority)
+        try:
+            self._metrics.observe_queue_wait(time.monotonic() - start, pool=pool)
+            self._metrics.add_in_flight(1)
+            try:
+                yield InstrumentedClient(client_pool.client, self._metrics)
+            finally:
+                self._metrics.add_in_flight(-1)
+        finally:
+            client_pool.semaphore.release()
+
+    def _get_bucket_name(self, container):
         if "." in self._bucket_name:
             char_delimiter = "."
         else:
@@ -352,14 +1550,35 @@ class S3BlobStore:
             base=self._bucket_name,
         )
 
-        bucket_name = bucket_name.replace("_", "-")
+        return bucket_name.replace("_", "-")
+
+    async def get_bucket_name(self, container=None):
+        """
+        Bucket of `container`, created if it does not exist yet.
+        """
+        if container is None:
+            container = task_vars.container.get()
+        bucket_name = self._get_bucket_name(container)
 
-        if bucket_name in self._cached_buckets:
+        expires = self._cached_buckets.get(bucket_name)
+        if expires is not None and expires > time.monotonic():
             return bucket_name
 
+        # concurrent first lookups for the same bucket share one request
+        lookup = self._bucket_lookups.get(bucket_name)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._ensure_bucket(bucket_name))
+            self._bucket_lookups[bucket_name] = lookup
+            lookup.add_done_callback(
+                lambda _: self._bucket_lookups.pop(bucket_name, None)
+            )
+        await asyncio.shield(lookup)
+        return bucket_name
+
+    async def _ensure_bucket(self, bucket_name):
         missing = False
         try:
-            async with self.s3_client() as client:
+            async with self.s3_client(pool=CONTROL_POOL) as client:
                 res = await client.head_bucket(Bucket=bucket_name)
                 if res["ResponseMetadata"]["HTTPStatusCode"] == 404:
                     missing = True
@@ -369,28 +1588,191 @@ class S3BlobStore:
                 missing = True
 
         if missing:
-            async with self.s3_client() as client:
-                await client.create_bucket(Bucket=bucket_name)
-        return bucket_name
+            try:
+                async with self.s3_client(pool=CONTROL_POOL) as client:
+                    await client.create_bucket(Bucket=bucket_name)
+            except botocore.exceptions.ClientError as e:
+                # another worker created it in the meantime
+                if e.response["Error"]["Code"] != "BucketAlreadyOwnedByYou":
+                    raise
+        self._cached_buckets[bucket_name] = time.monotonic() + self._bucket_cache_ttl
 
     async def initialize(self, app=None):
-        # No asyncio loop to run
         self.app = app
+        if self._reaper is not None:
+            self._reaper_task = asyncio.ensure_future(
+                self._reaper.run(self._reaper_interval)
+            )
 
     async def finalize(self, app=None):
-        await self._s3aioclient.close()
-
-    async def iterate_bucket(self):
-        container = task_vars.container.get()
-        bucket_name = await self.get_bucket_name()
-        async with self.s3_client() as client:
-            result = await client.list_objects(
-                Bucket=bucket_name, Prefix=container.id + "/"
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            await asyncio.gather(self._reaper_task, return_exceptions=True)
+        if self._cache is not None:
+            self._cache.close()
+        for pool in self._pools.values():
+            await pool.client.close()
+
+    async def iterate_bucket(self, container=None, **kwargs):
+        async for item in self.list_objects(container=container, **kwargs):
+            yield item
+
+    async def list_objects(self, container=None, **kwargs):
+        """
+        Iterate over the objects of a container bucket.
+
+        Takes the same arguments as `iterate_pages`.
+        """
+        async for page in self.iterate_pages(container=container, **kwargs):
+            for item in page.items:
+                yield item
+
+    async def iterate_pages(
+        self,
+        prefix=None,
+        delimiter=None,
+        start_after=None,
+        continuation_token=None,
+        page_size=1000,
+        max_keys=None,
+        container=None,
+        bucket_name=None,
+    ):
+        """
+        Iterate over the pages of a `list_objects_v2` listing.
+
+        `prefix` defaults to the container prefix. The next page is
+        requested while the current one is consumed. Pass the `cursor` of
+        a page as `continuation_token` to resume the listing after it.
+        The bucket of the container is created if needed, unless a
+        `bucket_name` is given.
+        """
+        if container is None:
+            container = task_vars.container.get()
+        if bucket_name is None:
+            bucket_name = await self.get_bucket_name(container)
+        if prefix is None:
+            prefix = container.id + "/"
+        params = {"Bucket": bucket_name, "Prefix": prefix}
+        if delimiter is not None:
+            params["Delimiter"] = delimiter
+        if start_after is not None:
+            params["StartAfter"] = start_after
+
+        def list_page(token):
+            page_params = dict(params, MaxKeys=page_size)
+            if remaining is not None:
+                # never ask for more than needed, so cursors stay exact
+                page_params["MaxKeys"] = min(page_size, remaining)
+            if token is not None:
+                page_params["ContinuationToken"] = token
+            return asyncio.ensure_future(self._list_objects_page(**page_params))
+
+        remaining = max_keys
+        next_page: Optional[asyncio.Future] = None
+        if remaining is None or remaining > 0:
+            next_page = list_page(continuation_token)
+        try:
+            while next_page is not None:
+                result = await next_page
+                next_page = None
+                items = result.get("Contents", [])
+                if remaining is not None:
+                    remaining -= len(items)
+                cursor = None
+                if result.get("IsTruncated"):
+                    cursor = result["NextContinuationToken"]
+                    if remaining is None or remaining > 0:
+                        next_page = list_page(cursor)
+                yield ListPage(
+                    items,
+                    [item["Prefix"] for item in result.get("CommonPrefixes", [])],
+                    cursor,
+                )
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    @retriable
+    async def _list_objects_page(self, **kwargs):
+        async with self.s3_client(pool=CONTROL_POOL) as client:
+            return await client.list_objects_v2(**kwargs)
+
+    async def delete_objects(self, keys, bucket_name=None):
+        """
+        Delete `keys` with batched `delete_objects` requests.
+
+        `keys` can be an iterable or an async iterable. Keys are sent in
+        batches of `DELETE_BATCH_SIZE`, and up to `delete_concurrency`
+        batches run at the same time. Returns the per key errors reported
+        by S3.
+        """
+        if bucket_name is None:
+            bucket_name = await self.get_bucket_name()
+        semaphore = asyncio.Semaphore(self._delete_concurrency)
+        errors = []
+        tasks = []
+
+        async def delete_batch(batch):
+            try:
+                result = await self._delete_objects_batch(bucket_name, batch)
+                errors.extend(result.get("Errors", []))
+            finally:
+                semaphore.release()
+
+        batch = []
+        async for key in _aiter(keys):
+            batch.append(key)
+            if len(batch) == DELETE_BATCH_SIZE:
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(delete_batch(batch)))
+                batch = []
+        if batch:
+            await semaphore.acquire()
+            tasks.append(asyncio.ensure_future(delete_batch(batch)))
+        await asyncio.gather(*tasks)
+
+        for error in errors:
+            log.warning(
+                f"Could not delete {error.get('Key')}: "
+                f"{error.get('Code')} {error.get('Message')}"
             )
-        async with self.s3_client() as client:
-            paginator = client.get_paginator("list_objects")
-            async for result in paginator.paginate(
-                Bucket=bucket_name, Prefix=container.id + "/"
-            ):
-                for item in result.get("Contents", []):
-                    yield item
+        return errors
+
+    @retriable
+    async def _delete_objects_batch(self, bucket_name, keys):
+        async with self.s3_client(
+            pool=CONTROL_POOL, priority=PRIORITY_BACKGROUND
+        ) as client:
+            return await client.delete_objects(
+                Bucket=bucket_name,
+                Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+            )
+
+    async def delete_container_objects(self, container=None):
+        """
+        Delete every object stored for `container`.
+
+        A container that never stored a file has no bucket, there is
+        nothing to delete then.
+        """
+        if container is None:
+            container = task_vars.container.get()
+        bucket_name = self._get_bucket_name(container)
+        keys = (
+            item["Key"]
+            async for item in self.iterate_bucket(container, bucket_name=bucket_name)
+        )
+        try:
+            return await self.delete_objects(keys, bucket_name)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchBucket":
+                raise
+            return []
+
+
+@configure.subscriber(for_=(IContainer, IObjectRemovedEvent))
+async def container_removed(container, event):
+    util = query_utility(IS3BlobStore)
+    if util is not None and util._cleanup_on_container_delete:
+        execute.after_request(util.delete_container_objects, container)
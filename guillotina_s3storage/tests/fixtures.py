@@ -20,7 +20,9 @@ def settings_configurator(settings):
         },
     }
 
-    if "S3CLOUD_ID" not in os.environ:
+    if os.environ.get("S3CLOUD_FAKE"):
+        settings["load_utilities"]["s3"]["settings"]["fake"] = True
+    elif "S3CLOUD_ID" not in os.environ:
         settings["load_utilities"]["s3"]["settings"].update(
             {"endpoint_url": "http://localhost:4566", "verify_ssl": False, "ssl": False}
         )
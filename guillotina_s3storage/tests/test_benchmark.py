@@ -0,0 +1,38 @@
+from guillotina import task_vars
+from guillotina.component import get_utility
+
+from guillotina_s3storage.benchmark import OPERATIONS
+from guillotina_s3storage.benchmark import Benchmark
+from guillotina_s3storage.benchmark import parse_size
+from guillotina_s3storage.interfaces import IS3BlobStore
+
+
+def test_parse_size():
+    assert parse_size("1KB") == 1024
+    assert parse_size("2.5mb") == int(2.5 * 1024 * 1024)
+    assert parse_size("1GB") == 1024**3
+    assert parse_size("100") == 100
+
+
+async def test_benchmark_with_fake(dummy_request):
+    util = get_utility(IS3BlobStore)
+    pools = util._pools
+    benchmark = Benchmark(
+        util,
+        sizes=(1024, 6 * 1024 * 1024),
+        concurrency=(1, 3),
+        pool_connections=(None, 2),
+        fake=True,
+    )
+    report = await benchmark.run()
+    assert util._pools is pools
+    assert task_vars.container.get() is None
+    assert report["backend"] == "fake"
+    assert len(report["results"]) == 2 * 2 * 2 * len(OPERATIONS)
+    for result in report["results"]:
+        assert result["ops_per_s"] > 0
+        if result["operation"] in ("upload", "download"):
+            assert result["mb_per_s"] > 0
+    # everything was cleaned up
+    assert benchmark.client.uploads == {}
+    assert all(not objects for objects in benchmark.client.buckets.values())
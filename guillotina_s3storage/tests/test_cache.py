@@ -0,0 +1,82 @@
+import asyncio
+import os
+
+from guillotina_s3storage.cache import BlobCache
+
+
+def _fetcher(data, calls):
+    async def fetch():
+        calls.append(data)
+        await asyncio.sleep(0)
+        return data
+
+    return fetch
+
+
+async def test_memory_cache_hits_and_evicts():
+    cache = BlobCache(memory_size=10, memory_max_object_size=4)
+    calls = []
+    assert await cache.get(("b", "a", None), _fetcher(b"aaaa", calls)) == b"aaaa"
+    assert await cache.get(("b", "a", None), _fetcher(b"aaaa", calls)) == b"aaaa"
+    assert calls == [b"aaaa"]
+
+    await cache.get(("b", "b", None), _fetcher(b"bbbb", calls))
+    await cache.get(("b", "c", None), _fetcher(b"cccc", calls))
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 3
+    assert stats["evictions"] == 1
+    assert stats["memory_bytes"] == 8
+
+    # least recently used object was evicted
+    await cache.get(("b", "a", None), _fetcher(b"aaaa", calls))
+    assert cache.stats()["misses"] == 4
+
+
+async def test_disk_cache(tmp_path):
+    def make_cache():
+        return BlobCache(
+            memory_size=10,
+            memory_max_object_size=2,
+            disk_path=str(tmp_path / "cache"),
+            disk_size=10,
+            disk_max_object_size=6,
+        )
+
+    def files(cache):
+        return list(os.scandir(cache._disk_dir))
+
+    cache = make_cache()
+    calls = []
+    assert cache.cacheable(6)
+    assert not cache.cacheable(7)
+    assert await cache.get(("b", "a", "1"), _fetcher(b"aaaaaa", calls)) == b"aaaaaa"
+    assert await cache.get(("b", "a", "1"), _fetcher(b"aaaaaa", calls)) == b"aaaaaa"
+    assert calls == [b"aaaaaa"]
+    assert cache.stats()["disk_bytes"] == 6
+    assert len(files(cache)) == 1
+
+    # another process sharing the path keeps its own files
+    other = make_cache()
+    await other.get(("b", "a", "1"), _fetcher(b"aaaaaa", calls))
+    assert len(files(cache)) == 1
+    other.close()
+    assert len(files(cache)) == 1
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    cache.invalidate("b", "a")
+    assert cache.stats()["disk_bytes"] == 0
+    assert len(files(cache)) == 0
+    cache.close()
+    assert len(list((tmp_path / "cache").iterdir())) == 0
+
+
+async def test_concurrent_misses_are_coalesced():
+    cache = BlobCache()
+    calls = []
+    results = await asyncio.gather(
+        *[cache.get(("b", "a", None), _fetcher(b"data", calls)) for _ in range(5)]
+    )
+    assert results == [b"data"] * 5
+    assert calls == [b"data"]
+    assert cache.stats()["coalesced"] == 4
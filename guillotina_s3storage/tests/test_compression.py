@@ -0,0 +1,65 @@
+import gzip
+
+from guillotina_s3storage.compression import Compression
+from guillotina_s3storage.compression import decompress
+from guillotina_s3storage.compression import pack_frames
+from guillotina_s3storage.compression import select_frames
+from guillotina_s3storage.compression import stored_size
+from guillotina_s3storage.compression import unpack_frames
+
+
+async def _aiter(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def test_applies_to_content_types():
+    compression = Compression(content_types=["text/*", "application/json"])
+    assert compression.applies("text/csv")
+    assert compression.applies("application/json; charset=utf-8")
+    assert not compression.applies("image/png")
+    assert not compression.applies(None)
+
+
+def test_select_frames():
+    frames = [(10, 4), (10, 5), (5, 3)]
+    assert select_frames(frames) == (frames, 0, 0)
+    assert select_frames(frames, 12, 14) == ([(10, 5)], 10, 4)
+    assert select_frames(frames, 9, 21) == (frames, 0, 0)
+    assert select_frames(frames, 25) == ([], 0, 0)
+    assert unpack_frames(pack_frames(frames)) == frames
+    assert stored_size(pack_frames(frames)) == 12
+
+
+async def test_compress_in_frames():
+    data = b"".join(b"line %d\n" % idx for idx in range(10000))
+    compression = Compression(frame_size=16 * 1024)
+    frames = []
+    chunks = [
+        chunk
+        async for chunk in compression.compress(
+            _aiter([data[:1000], data[1000:50000], data[50000:]]), frames
+        )
+    ]
+    stored = b"".join(chunks)
+    assert len(chunks) == len(frames) == -(-len(data) // (16 * 1024))
+    assert sum(raw for raw, _ in frames) == len(data)
+    assert len(stored) < len(data)
+    # the frames are a valid multi member gzip stream
+    assert gzip.decompress(stored) == data
+
+    selected, raw_offset, stored_offset = select_frames(frames, 20000, 40000)
+    stored_end = stored_offset + sum(compressed for _, compressed in selected)
+    result = b"".join(
+        [
+            chunk
+            async for chunk in decompress(
+                "gzip",
+                _aiter([stored[stored_offset:stored_end]]),
+                selected,
+                skip=20000 - raw_offset,
+                length=20000,
+            )
+        ]
+    )
+    assert result == data[20000:40000]
@@ -0,0 +1,120 @@
+import base64
+import hashlib
+
+import aiohttp
+import botocore.exceptions
+import pytest
+from guillotina.component import get_utility
+
+from guillotina_s3storage.fake import FakeS3Client
+from guillotina_s3storage.interfaces import IS3BlobStore
+from guillotina_s3storage.pools import ClientPool
+
+
+async def test_inject_fault():
+    client = FakeS3Client()
+    await client.create_bucket(Bucket="bucket")
+    client.inject_fault("put_object", "SlowDown")
+    with pytest.raises(botocore.exceptions.ClientError) as exc_info:
+        await client.put_object(Bucket="bucket", Key="key", Body=b"data")
+    assert exc_info.value.response["Error"]["Code"] == "SlowDown"
+    assert exc_info.value.response["ResponseMetadata"]["HTTPStatusCode"] == 503
+
+    await client.put_object(Bucket="bucket", Key="key", Body=b"data")
+    response = await client.get_object(Bucket="bucket", Key="key", Range="bytes=1-2")
+    async with response["Body"] as stream:
+        assert await stream.read() == b"at"
+
+
+async def test_payload_errors():
+    client = FakeS3Client(payload_error_rate=1)
+    await client.create_bucket(Bucket="bucket")
+    await client.put_object(Bucket="bucket", Key="key", Body=b"data")
+    response = await client.get_object(Bucket="bucket", Key="key")
+    with pytest.raises(aiohttp.ClientPayloadError):
+        await response["Body"].read()
+
+
+async def test_content_md5():
+    client = FakeS3Client(keep_data=False)
+    await client.create_bucket(Bucket="bucket")
+    content_md5 = base64.b64encode(hashlib.md5(b"data").digest()).decode()
+    response = await client.put_object(
+        Bucket="bucket", Key="key", Body=b"data", ContentMD5=content_md5
+    )
+    assert response["ETag"] == f'"{hashlib.md5(b"data").hexdigest()}"'
+    with pytest.raises(botocore.exceptions.ClientError) as exc_info:
+        await client.put_object(
+            Bucket="bucket", Key="key", Body=b"date", ContentMD5=content_md5
+        )
+    assert exc_info.value.response["Error"]["Code"] == "BadDigest"
+
+
+async def test_parts_too_small():
+    client = FakeS3Client(keep_data=False)
+    await client.create_bucket(Bucket="bucket")
+    mpu = await client.create_multipart_upload(Bucket="bucket", Key="key")
+    parts = []
+    for part_number, size in enumerate((5 * 1024 * 1024, 1024, 1024), 1):
+        part = await client.upload_part(
+            Bucket="bucket",
+            Key="key",
+            PartNumber=part_number,
+            UploadId=mpu["UploadId"],
+            Body=b"x" * size,
+        )
+        parts.append({"PartNumber": part_number, "ETag": part["ETag"]})
+
+    with pytest.raises(botocore.exceptions.ClientError) as exc_info:
+        await client.complete_multipart_upload(
+            Bucket="bucket",
+            Key="key",
+            UploadId=mpu["UploadId"],
+            MultipartUpload={"Parts": parts},
+        )
+    assert exc_info.value.response["Error"]["Code"] == "EntityTooSmall"
+
+    # only the last part can be smaller
+    await client.complete_multipart_upload(
+        Bucket="bucket",
+        Key="key",
+        UploadId=mpu["UploadId"],
+        MultipartUpload={"Parts": parts[:2]},
+    )
+
+
+async def test_seeded_faults():
+    async def failures(client):
+        result = []
+        for _ in range(20):
+            try:
+                await client.head_bucket(Bucket="bucket")
+            except botocore.exceptions.ClientError as ex:
+                result.append(ex.response["Error"]["Code"])
+            else:
+                result.append(None)
+        return result
+
+    first = FakeS3Client(seed=1)
+    second = FakeS3Client(seed=1)
+    for client in (first, second):
+        await client.create_bucket(Bucket="bucket")
+        client.error_rate = client.throttle_rate = 0.3
+    result = await failures(first)
+    assert result == await failures(second)
+    assert {"InternalError", "SlowDown", None} == set(result)
+
+
+async def test_retry_throttled_requests(dummy_request):
+    util = get_utility(IS3BlobStore)
+    pools = util._pools
+    client = FakeS3Client()
+    await client.create_bucket(Bucket="bucket")
+    client.inject_fault("list_objects_v2", "SlowDown")
+    util._pools = {"default": ClientPool(client, 10)}
+    try:
+        result = await util._list_objects_page(Bucket="bucket")
+    finally:
+        util._pools = pools
+    assert result["KeyCount"] == 0
+    assert util.metrics_snapshot()["retries"]["_list_objects_page"] == 1
@@ -0,0 +1,38 @@
+from guillotina_s3storage.metrics import Histogram
+from guillotina_s3storage.metrics import S3Metrics
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1.0, float("inf")))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 3
+    assert snapshot["sum"] == 5.55
+    assert snapshot["buckets"] == {0.1: 1, 1.0: 2, float("inf"): 3}
+
+
+def test_metrics_hooks():
+    observed = []
+
+    def hook(metric, value, **labels):
+        observed.append((metric, value, labels))
+
+    metrics = S3Metrics(hooks=[hook])
+    metrics.observe_request("get_object", 0.2)
+    metrics.observe_request("head_object", 0.1, error="403")
+    metrics.record_retry("_download", "throttle")
+    metrics.add_bytes(sent=10)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["latency"]["get_object"]["count"] == 1
+    assert snapshot["errors"] == {"head_object": 1}
+    assert snapshot["retries"] == {"_download": 1}
+    assert snapshot["retry_reasons"] == {"throttle": 1}
+    assert snapshot["bytes_sent"] == 10
+    assert observed == [
+        ("s3_request_seconds", 0.2, {"operation": "get_object", "error": None}),
+        ("s3_request_seconds", 0.1, {"operation": "head_object", "error": "403"}),
+        ("s3_retries", 1, {"operation": "_download", "reason": "throttle"}),
+        ("s3_bytes", 10, {"direction": "sent"}),
+    ]
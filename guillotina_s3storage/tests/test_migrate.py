@@ -0,0 +1,86 @@
+import json
+import uuid
+
+from guillotina import task_vars
+from guillotina.component import get_utility
+from guillotina.content import Container
+from guillotina.tests.utils import create_content
+from guillotina.tests.utils import login
+
+from guillotina_s3storage.interfaces import IS3BlobStore
+from guillotina_s3storage.migrate import BucketMigration
+
+
+async def _setup(container_id, names, size=1000):
+    login()
+    # the buckets of earlier runs may still be there
+    container_id = f"{container_id}-{uuid.uuid4().hex[:8]}"
+    container = create_content(Container, id=container_id)
+    task_vars.container.set(container)
+    util = get_utility(IS3BlobStore)
+    bucket = await util.get_bucket_name()
+    for name in names:
+        await util._s3aioclient.put_object(
+            Bucket=bucket,
+            Key=f"{container_id}/{name}",
+            Body=(size * name.encode())[:size],
+        )
+    return util, container
+
+
+async def test_migrate_server_side(dummy_request, tmp_path, monkeypatch):
+    util, container = await _setup("migrate", ["a", "b", "c"])
+    checkpoint = str(tmp_path / "checkpoint.json")
+    migration = BucketMigration(
+        util, "migrated-server-side", checkpoint=checkpoint, page_size=1
+    )
+    copy_object = migration._copy_object
+    calls = []
+
+    async def fail_once(bucket, item):
+        calls.append(item["Key"])
+        if item["Key"].endswith("/b") and calls.count(item["Key"]) == 1:
+            raise Exception("Connection lost")
+        await copy_object(bucket, item)
+
+    monkeypatch.setattr(migration, "_copy_object", fail_once)
+    result = await migration.run(container)
+    assert result["objects"] == 1
+    assert result["failed"][0]["key"] == f"{container.id}/b"
+    assert not result["done"]
+    with open(checkpoint) as fi:
+        assert json.load(fi)["objects"] == 1
+
+    # resumes after the last copied page
+    result = await migration.run(container)
+    assert result["failed"] == []
+    assert result["done"]
+    assert result["objects"] == 3
+    assert result["bytes"] == 3000
+    assert calls.count(f"{container.id}/a") == 1
+
+    response = await util._s3aioclient.get_object(
+        Bucket="migrated-server-side", Key=f"{container.id}/c"
+    )
+    async with response["Body"] as stream:
+        assert await stream.read() == 1000 * b"c"
+
+
+async def test_migrate_streamed(dummy_request):
+    util, container = await _setup("stream", ["large"], size=6 * 1024 * 1024)
+    migration = BucketMigration(
+        util,
+        "migrated-streamed",
+        target_client=util._s3aioclient,
+        part_size=5 * 1024 * 1024,
+    )
+    result = await migration.run(container)
+    assert result["failed"] == []
+    assert result["objects"] == 1
+    assert not result["server_side"]
+
+    response = await util._s3aioclient.head_object(
+        Bucket="migrated-streamed", Key=f"{container.id}/large"
+    )
+    assert response["ContentLength"] == 6 * 1024 * 1024
+    assert response["ETag"].endswith('-2"')
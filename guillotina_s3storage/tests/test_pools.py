@@ -0,0 +1,43 @@
+import asyncio
+
+from guillotina_s3storage.pools import PRIORITY_BACKGROUND
+from guillotina_s3storage.pools import PRIORITY_INTERACTIVE
+from guillotina_s3storage.pools import PRIORITY_NORMAL
+from guillotina_s3storage.pools import PrioritySemaphore
+
+
+async def test_priority_semaphore_serves_by_priority():
+    semaphore = PrioritySemaphore(1)
+    await semaphore.acquire()
+    assert semaphore.locked()
+
+    served = []
+
+    async def worker(name, priority):
+        await semaphore.acquire(priority)
+        served.append(name)
+        semaphore.release()
+
+    tasks = [
+        asyncio.ensure_future(worker("copy", PRIORITY_BACKGROUND)),
+        asyncio.ensure_future(worker("upload", PRIORITY_NORMAL)),
+        asyncio.ensure_future(worker("download", PRIORITY_INTERACTIVE)),
+        asyncio.ensure_future(worker("upload2", PRIORITY_NORMAL)),
+    ]
+    await asyncio.sleep(0)
+    semaphore.release()
+    await asyncio.gather(*tasks)
+    assert served == ["download", "upload", "upload2", "copy"]
+    assert not semaphore.locked()
+
+
+async def test_priority_semaphore_cancelled_waiter():
+    semaphore = PrioritySemaphore(1)
+    await semaphore.acquire()
+    waiter = asyncio.ensure_future(semaphore.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.sleep(0)
+    semaphore.release()
+    assert not semaphore.locked()
+    await asyncio.wait_for(semaphore.acquire(), 1)
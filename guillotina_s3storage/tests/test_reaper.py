@@ -0,0 +1,155 @@
+import random
+import time
+
+import botocore.exceptions
+import pytest
+from guillotina import task_vars
+from guillotina._settings import app_settings
+from guillotina.component import get_global_components
+from guillotina.component import get_utility
+from guillotina.content import Container
+from guillotina.files.adapter import DBDataManager
+from guillotina.interfaces import IExternalFileStorageManager
+from guillotina.interfaces import IUploadDataManager
+from guillotina.tests.utils import create_content
+from guillotina.tests.utils import login
+from zope.interface import Interface
+
+from guillotina_s3storage import reaper
+from guillotina_s3storage.interfaces import IS3BlobStore
+from guillotina_s3storage.reaper import MultipartReaper
+from guillotina_s3storage.storage import S3FileField
+
+
+class IUploads(Interface):
+    file = S3FileField()
+
+
+class FakeResource:
+    type_name = "Item"
+    __behaviors_schemas__ = (IUploads,)
+
+    def __init__(self, uid, uploads=None):
+        self.__uuid__ = uid
+        if uploads is not None:
+            self.__uploads__ = uploads
+
+
+# upload state stored outside of the resource, like in Redis
+_stored_uploads: dict = {}
+
+
+class StoredDataManager(DBDataManager):
+    async def load(self):
+        key = (self.context.__uuid__, self.field.__name__)
+        self._data = _stored_uploads.setdefault(key, {})
+
+
+async def test_reap_stale_uploads(dummy_request, monkeypatch):
+    login()
+    container = create_content(Container, id="test-container")
+    task_vars.container.set(container)
+    util = get_utility(IS3BlobStore)
+    bucket = await util.get_bucket_name()
+    uploads = {}
+
+    async def get_object_by_uid(uid):
+        if uid in uploads:
+            return FakeResource(uid, {"file": uploads[uid]})
+        raise KeyError(uid)
+
+    monkeypatch.setattr(reaper, "get_object_by_uid", get_object_by_uid)
+
+    # uploads left over by other tests
+    await MultipartReaper(util, max_age=-60).reap_container(container)
+
+    for name in ("abandoned", "active"):
+        key = f"test-container/{name}::{name}"
+        mpu = await util._s3aioclient.create_multipart_upload(Bucket=bucket, Key=key)
+        await util._s3aioclient.upload_part(
+            Bucket=bucket,
+            Key=key,
+            PartNumber=1,
+            UploadId=mpu["UploadId"],
+            Body=1000 * b"x",
+        )
+        state = {
+            "_upload_file_id": key,
+            "_mpu": mpu,
+            # active until after the reaper runs
+            "last_activity": time.time() + 60,
+        }
+        if name == "active":
+            uploads[name] = state
+
+    result = await MultipartReaper(util, max_age=0).reap_container(container)
+    assert result == {"aborted": 1, "bytes": 1000}
+    remaining = await util._s3aioclient.list_multipart_uploads(
+        Bucket=bucket, Prefix="test-container/"
+    )
+    assert [upload["Key"] for upload in remaining["Uploads"]] == [
+        "test-container/active::active"
+    ]
+
+    uploads["active"]["last_activity"] = 0
+    result = await MultipartReaper(util, max_age=0).reap_container(container)
+    assert result == {"aborted": 1, "bytes": 1000}
+    task_vars.container.set(None)
+
+
+async def test_reap_uploads_of_configured_data_manager(dummy_request, monkeypatch):
+    login()
+    container = create_content(Container, id="test-container")
+    task_vars.container.set(container)
+    util = get_utility(IS3BlobStore)
+    bucket = await util.get_bucket_name()
+
+    components = get_global_components()
+    components.registerAdapter(
+        StoredDataManager, (IExternalFileStorageManager,), IUploadDataManager, "stored"
+    )
+    monkeypatch.setitem(app_settings, "cloud_datamanager", "stored")
+
+    async def get_object_by_uid(uid):
+        return FakeResource(uid)
+
+    monkeypatch.setattr(reaper, "get_object_by_uid", get_object_by_uid)
+
+    await MultipartReaper(util, max_age=-60).reap_container(container)
+
+    key = "test-container/active::active"
+    mpu = await util._s3aioclient.create_multipart_upload(Bucket=bucket, Key=key)
+    _stored_uploads[("active", "file")] = {
+        "_upload_file_id": key,
+        "_mpu": mpu,
+        "last_activity": time.time() + 60,
+    }
+    try:
+        result = await MultipartReaper(util, max_age=0).reap_container(container)
+        assert result["aborted"] == 0
+
+        _stored_uploads[("active", "file")]["last_activity"] = 0
+        result = await MultipartReaper(util, max_age=0).reap_container(container)
+        assert result["aborted"] == 1
+    finally:
+        components.unregisterAdapter(
+            StoredDataManager,
+            (IExternalFileStorageManager,),
+            IUploadDataManager,
+            "stored",
+        )
+        _stored_uploads.clear()
+        task_vars.container.set(None)
+
+
+async def test_reap_container_without_bucket(dummy_request):
+    login()
+    container = create_content(Container, id=f"empty-{random.randint(0, 10**9)}")
+    util = get_utility(IS3BlobStore)
+
+    result = await MultipartReaper(util, max_age=0).reap_container(container)
+    assert result == {"aborted": 0, "bytes": 0}
+
+    # the bucket of the container is not created to be reaped
+    with pytest.raises(botocore.exceptions.ClientError):
+        await util._s3aioclient.head_bucket(Bucket=util._get_bucket_name(container))
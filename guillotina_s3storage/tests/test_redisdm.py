@@ -0,0 +1,88 @@
+import pytest
+
+
+pytest.importorskip("redis")
+
+from guillotina_s3storage.redisdm import S3RedisDataManager  # noqa: E402
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def hset(self, key, mapping):
+        self.calls.append(("hset", key, mapping))
+
+    def expire(self, key, ttl):
+        self.calls.append(("expire", key, ttl))
+
+    async def execute(self):
+        for call in self.calls:
+            if call[0] == "hset":
+                self.redis.hashes.setdefault(call[1], {}).update(
+                    {str(k).encode(): v.encode() for k, v in call[2].items()}
+                )
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+        self.pool = self
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def hgetall(self, key):
+        return self.hashes.get(key, {})
+
+    async def delete(self, key):
+        self.hashes.pop(key, None)
+
+    async def expire(self, key, ttl):
+        pass
+
+
+class FakeContext:
+    __uuid__ = "uuid"
+
+
+class FakeField:
+    __name__ = "file"
+    context = None
+
+
+class FakeStorageManager:
+    context = FakeContext()
+    request = None
+    field = FakeField()
+
+
+async def test_register_parts():
+    dm = S3RedisDataManager(FakeStorageManager())
+    dm._redis = FakeRedis()
+    dm._data = {}
+
+    await dm.register_parts(
+        [
+            {"PartNumber": 10, "ETag": '"10"'},
+            {"PartNumber": 2, "ETag": '"2"'},
+        ]
+    )
+    await dm.register_parts([{"PartNumber": 1, "ETag": '"1"'}])
+    # retried parts replace the previous upload
+    await dm.register_parts([{"PartNumber": 2, "ETag": '"2b"'}])
+    assert await dm.get_parts() == [
+        {"PartNumber": 1, "ETag": '"1"'},
+        {"PartNumber": 2, "ETag": '"2b"'},
+        {"PartNumber": 10, "ETag": '"10"'},
+    ]
+
+    await dm.start()
+    assert await dm.get_parts() == []
@@ -0,0 +1,108 @@
+import botocore.exceptions
+import pytest
+
+from guillotina_s3storage.metrics import S3Metrics
+from guillotina_s3storage.retry import FATAL
+from guillotina_s3storage.retry import THROTTLE
+from guillotina_s3storage.retry import TRANSIENT
+from guillotina_s3storage.retry import RetryPolicy
+from guillotina_s3storage.retry import classify
+from guillotina_s3storage.retry import get_retry_after
+from guillotina_s3storage.retry import retriable
+
+
+def _error(code, status, headers=None):
+    return botocore.exceptions.ClientError(
+        {
+            "Error": {"Code": code, "Message": code},
+            "ResponseMetadata": {
+                "HTTPStatusCode": status,
+                "HTTPHeaders": headers or {},
+            },
+        },
+        "GetObject",
+    )
+
+
+def test_classify():
+    assert classify(_error("SlowDown", 503)) == THROTTLE
+    assert classify(_error("TooManyRequests", 429)) == THROTTLE
+    assert classify(_error("InternalError", 500)) == TRANSIENT
+    assert classify(_error("AccessDenied", 403)) == FATAL
+    assert classify(_error("NoSuchKey", 404)) == FATAL
+    assert classify(botocore.exceptions.EndpointConnectionError(endpoint_url="x")) == (
+        TRANSIENT
+    )
+    incomplete = botocore.exceptions.IncompleteReadError(
+        actual_bytes=1, expected_bytes=2
+    )
+    assert classify(incomplete) == TRANSIENT
+    # raised before the request is sent, retrying can not help
+    assert classify(botocore.exceptions.ParamValidationError(report="x")) == FATAL
+    assert classify(botocore.exceptions.NoCredentialsError()) == FATAL
+
+
+def test_retry_after():
+    assert get_retry_after(_error("SlowDown", 503, {"retry-after": "3"})) == 3
+    assert get_retry_after(_error("SlowDown", 503)) is None
+    policy = RetryPolicy(throttle_delay=0.1, max_delay=5)
+    error = _error("SlowDown", 503, {"retry-after": "2"})
+    assert policy.get_delay(THROTTLE, 0, error) == 2
+    # decorrelated jitter stays within the bounds
+    for previous in (0, 0.1, 1, 10):
+        assert 0.1 <= policy.get_delay(THROTTLE, previous) <= 5
+
+
+async def test_fatal_errors_are_not_retried():
+    metrics = S3Metrics()
+    policy = RetryPolicy(base_delay=0, metrics=metrics)
+    calls = []
+
+    @retriable(lambda: policy)
+    async def get(bucket):
+        calls.append(bucket)
+        raise _error("NoSuchKey", 404)
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        await get("bucket")
+    assert calls == ["bucket"]
+    assert metrics.snapshot()["retries"] == {}
+
+
+async def test_retries_and_budget():
+    metrics = S3Metrics()
+    policy = RetryPolicy(
+        base_delay=0, max_tries=3, budget_ratio=0, budget_max_tokens=3, metrics=metrics
+    )
+    calls = []
+
+    @retriable(lambda: policy)
+    async def get(bucket_name):
+        calls.append(bucket_name)
+        if len(calls) < 3:
+            raise _error("InternalError", 500)
+        return "data"
+
+    assert await get("bucket") == "data"
+    assert len(calls) == 3
+
+    @retriable(lambda: policy)
+    async def put(bucket_name):
+        calls.append(bucket_name)
+        raise _error("InternalError", 500)
+
+    # a single token is left in the budget of the bucket
+    calls.clear()
+    with pytest.raises(botocore.exceptions.ClientError):
+        await put("bucket")
+    assert len(calls) == 2
+    # other buckets have their own budget
+    calls.clear()
+    with pytest.raises(botocore.exceptions.ClientError):
+        await put("other")
+    assert len(calls) == 3
+
+    snapshot = metrics.snapshot()
+    assert snapshot["retries"] == {"get": 2, "put": 3}
+    assert snapshot["retry_reasons"] == {"transient": 5}
+    assert snapshot["giveup_reasons"] == {"budget": 1, "transient": 1}
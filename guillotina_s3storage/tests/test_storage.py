@@ -1,7 +1,10 @@
 import asyncio
 import base64
+import gzip
+import os
 import random
 from hashlib import md5
+from hashlib import sha256
 
 import backoff
 import botocore.exceptions
@@ -18,7 +21,12 @@ from guillotina.tests.utils import create_content
 from guillotina.tests.utils import login
 from zope.interface import Interface
 
+from guillotina_s3storage import storage
+from guillotina_s3storage.cache import BlobCache
+from guillotina_s3storage.cache import BlockCache
+from guillotina_s3storage.compression import Compression
 from guillotina_s3storage.interfaces import IS3BlobStore
+from guillotina_s3storage.pools import ClientPool
 from guillotina_s3storage.storage import CHUNK_SIZE
 from guillotina_s3storage.storage import DEFAULT_MAX_POOL_CONNECTIONS
 from guillotina_s3storage.storage import RETRIABLE_EXCEPTIONS
@@ -330,11 +338,7 @@ async def test_multipart_upload_with_tus_and_tid_conflict(upload_request, reader
     # do this chunk over again...
     ob.__uploads__["file"]["offset"] -= len(chunk)
     ob.__uploads__["file"]["_block"] -= 1
-    ob.__uploads__["file"]["_multipart"]["Parts"] = ob.__uploads__["file"][
-        "_multipart"
-    ]["Parts"][
-        :-1
-    ]  # noqa
+    ob.__uploads__["file"]["_parts"] = ob.__uploads__["file"]["_parts"][:-16]
     reader.set(chunk)
     upload_request._cache_data = b""
     upload_request._last_read_pos = 0
@@ -649,10 +653,16 @@ async def test_file_exists(upload_request):
 
     assert await s3mng.exists()
 
+    stat = await s3mng.stat()
+    assert stat["size"] == len(_test_gif)
+    assert stat["etag"]
+    assert stat["last_modified"] is not None
+
     await s3mng.delete_upload(ob.file.uri)
     assert len(await get_all_objects()) == 0
 
     assert not await s3mng.exists()
+    assert await s3mng.stat() is None
 
 
 @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=2)
@@ -757,3 +767,750 @@ async def test_connection_leak(util):
 
     for task in done:
         assert task.exception() is None, task.exception()
+
+
+async def test_save_file_concurrent_parts(util, upload_request):
+    util._upload_concurrency = 3
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        for char in b"ABCD":
+            yield CHUNK_SIZE * bytes([char])
+
+    try:
+        await mng.save_file(generator, content_type="application/data")
+    finally:
+        util._upload_concurrency = 1
+    assert ob.file.size == CHUNK_SIZE * 4
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == b"".join(CHUNK_SIZE * bytes([char]) for char in b"ABCD")
+
+
+async def test_download_parallel_ranges(util, upload_request):
+    upload_request.headers.update(
+        {
+            "Content-Type": "image/gif",
+            "X-UPLOAD-MD5HASH": md5(_test_gif).hexdigest(),
+            "X-UPLOAD-EXTENSION": "gif",
+            "X-UPLOAD-SIZE": len(_test_gif),
+            "X-UPLOAD-FILENAME": "test.gif",
+        }
+    )
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    await mng.upload()
+
+    util._download_concurrency = 3
+    util._download_part_size = 500
+    try:
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        data = b""
+        async for chunk in s3mng.iter_data():
+            data += chunk
+        assert data == _test_gif
+
+        data = b""
+        async for chunk in s3mng.read_range(100, 1700):
+            data += chunk
+        assert data == _test_gif[100:1700]
+    finally:
+        util._download_concurrency = 1
+        util._download_part_size = 8 * 1024 * 1024
+
+
+async def test_bucket_name_is_cached(util):
+    bucket_name = await util.get_bucket_name()
+    util._cached_buckets.clear()
+
+    calls = []
+    head_bucket = util._s3aioclient.head_bucket
+
+    async def counted_head_bucket(**kwargs):
+        calls.append(kwargs["Bucket"])
+        return await head_bucket(**kwargs)
+
+    util._s3aioclient.head_bucket = counted_head_bucket
+    try:
+        names = await asyncio.gather(*[util.get_bucket_name() for _ in range(10)])
+        assert set(names) == {bucket_name}
+        await util.get_bucket_name()
+    finally:
+        del util._s3aioclient.head_bucket
+    assert calls == [bucket_name]
+
+
+async def test_copy_multipart(util, upload_request):
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        for char in b"ABC":
+            yield CHUNK_SIZE * bytes([char])
+
+    await mng.save_file(generator, content_type="application/data")
+
+    new_ob = create_content()
+    new_ob.file = None
+    gmng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    new_gmng = S3FileStorageManager(
+        new_ob, upload_request, IContent["file"].bind(new_ob)
+    )
+    new_dm = DBDataManager(new_gmng)
+    await new_dm.load()
+
+    util._copy_multipart_threshold = 0
+    util._copy_part_size = CHUNK_SIZE * 2
+    try:
+        await gmng.copy(new_gmng, new_dm)
+    finally:
+        util._copy_multipart_threshold = 5 * 1024 * 1024 * 1024
+        util._copy_part_size = 256 * 1024 * 1024
+
+    assert new_ob.file.uri != ob.file.uri
+    assert new_ob.file._bucket_name == ob.file._bucket_name
+    data = b""
+    async for chunk in new_gmng.iter_data():
+        data += chunk
+    assert data == b"".join(CHUNK_SIZE * bytes([char]) for char in b"ABC")
+    assert len(await get_all_objects()) == 2
+
+
+async def test_save_file_coalesces_chunks(util, upload_request):
+    util._upload_concurrency = 2
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    small = b"S" * 1024 * 1024
+    large = b"L" * int(CHUNK_SIZE * 2.5)
+
+    async def generator():
+        for _ in range(7):
+            yield small
+        yield large
+
+    try:
+        await mng.save_file(generator, content_type="application/data")
+    finally:
+        util._upload_concurrency = 1
+    assert ob.file.size == 7 * len(small) + len(large)
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == 7 * small + large
+
+
+async def test_part_size_from_upload_size(util, upload_request):
+    assert util.get_part_size(None) == CHUNK_SIZE
+    assert util.get_part_size(1024) == CHUNK_SIZE
+    assert util.get_part_size(100 * 1024**3) == 11 * 1024 * 1024
+    # declared sizes do not make parts larger than max_part_size
+    assert util.get_part_size(100 * 1024**4) == 256 * 1024 * 1024
+
+    ob = create_content()
+    ob.file = None
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    dm = DBDataManager(s3mng)
+    await dm.load()
+    await dm.start()
+    await dm.update(size=200 * 1024**3)
+    await s3mng.start(dm)
+    assert dm.get("_part_size") == 21 * 1024 * 1024
+
+
+async def test_part_buffers_grow_with_data():
+    pool = storage._PartBufferPool(2)
+    part_size = 256 * 1024 * 1024
+
+    async def chunks():
+        yield b"x" * 1024
+        yield b"y" * 1024
+
+    parts = [part async for part in storage._iter_parts(chunks(), part_size, pool)]
+    assert [bytes(body) for body, _ in parts] == [b"x" * 1024 + b"y" * 1024]
+    # only the data received is held in memory, not a whole part
+    assert parts[0][1].__sizeof__() < 1024 * 1024
+
+
+async def test_delete_objects_in_batches(util, upload_request, monkeypatch):
+    monkeypatch.setattr(storage, "DELETE_BATCH_SIZE", 2)
+
+    async def generator():
+        yield 5000 * b"x"
+
+    for _ in range(5):
+        ob = create_content()
+        ob.file = None
+        mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+        await mng.save_file(generator, content_type="application/data")
+    assert len(await get_all_objects()) == 5
+
+    errors = await util.delete_container_objects()
+    assert errors == []
+    assert len(await get_all_objects()) == 0
+
+
+async def test_delete_container_objects_without_bucket(util):
+    container = create_content(Container, id=f"empty-{random.randint(0, 10**9)}")
+    assert await util.delete_container_objects(container) == []
+
+    # the bucket of the container is not created to be emptied
+    with pytest.raises(botocore.exceptions.ClientError):
+        await util._s3aioclient.head_bucket(Bucket=util._get_bucket_name(container))
+
+
+async def test_list_objects(util, upload_request):
+    async def generator():
+        yield 5000 * b"x"
+
+    for _ in range(5):
+        ob = create_content()
+        ob.file = None
+        mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+        await mng.save_file(generator, content_type="application/data")
+
+    keys = [item["Key"] async for item in util.list_objects(page_size=2)]
+    assert len(keys) == 5
+    assert keys == sorted(keys)
+
+    pages = [page async for page in util.iterate_pages(page_size=2)]
+    assert [len(page.items) for page in pages] == [2, 2, 1]
+    assert pages[-1].cursor is None
+
+    resumed = [
+        item["Key"]
+        async for item in util.list_objects(
+            page_size=2, continuation_token=pages[0].cursor
+        )
+    ]
+    assert resumed == keys[2:]
+
+    limited = [item["Key"] async for item in util.list_objects(max_keys=3)]
+    assert limited == keys[:3]
+
+    after = [item["Key"] async for item in util.list_objects(start_after=keys[3])]
+    assert after == keys[4:]
+
+    pages = [
+        page
+        async for page in util.iterate_pages(prefix="test-container", delimiter="/")
+    ]
+    assert pages[0].items == []
+    assert pages[0].prefixes == ["test-container/"]
+
+
+async def test_download_from_cache(util, upload_request):
+    upload_request.headers.update(
+        {
+            "Content-Type": "image/gif",
+            "X-UPLOAD-MD5HASH": md5(_test_gif).hexdigest(),
+            "X-UPLOAD-EXTENSION": "gif",
+            "X-UPLOAD-SIZE": len(_test_gif),
+            "X-UPLOAD-FILENAME": "test.gif",
+        }
+    )
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    await mng.upload()
+    assert ob.file._etag is not None
+
+    util._cache = BlobCache()
+    try:
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        for _ in range(2):
+            data = b""
+            async for chunk in s3mng.iter_data():
+                data += chunk
+            assert data == _test_gif
+        async for chunk in s3mng.read_range(100, 200):
+            assert chunk == _test_gif[100:200]
+        assert util.cache_stats()["misses"] == 1
+        assert util.cache_stats()["hits"] == 2
+
+        await s3mng.delete_upload(ob.file.uri, ob.file._bucket_name)
+        assert util.cache_stats()["memory_objects"] == 0
+    finally:
+        util._cache = None
+
+
+async def test_read_ranges(util, upload_request):
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    data = bytes(range(256)) * 1024
+
+    async def generator():
+        yield data
+
+    await mng.save_file(generator, content_type="application/data")
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+
+    ranges = [(200000, 200100), (10, 20), (30, 40), (0, 5), (100000, 100000)]
+    latency = util.metrics_snapshot()["latency"]
+    before = latency.get("get_object", {}).get("count", 0)
+    chunks = [chunk async for chunk in s3mng.read_ranges(ranges, gap=100)]
+    assert chunks == [data[start:end] for start, end in ranges]
+    # the three ranges at the start are read with a single GET
+    after = util.metrics_snapshot()["latency"]["get_object"]["count"]
+    assert after - before == 2
+
+
+async def test_read_ranges_block_cache(util, upload_request):
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    data = bytes(range(256)) * 1024
+
+    async def generator():
+        yield data
+
+    await mng.save_file(generator, content_type="application/data")
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+
+    util._block_cache = BlockCache(size=64 * 1024, block_size=4096)
+    try:
+        ranges = [(5000, 9000), (100, 200), (len(data) - 10, len(data))]
+        for _ in range(2):
+            chunks = [chunk async for chunk in s3mng.read_ranges(ranges)]
+            assert chunks == [data[start:end] for start, end in ranges]
+        stats = util.range_cache_stats()
+        assert stats["hits"] == 4
+        assert stats["misses"] == 4
+
+        async for chunk in s3mng.read_range(4000, 4200):
+            assert chunk == data[4000:4200]
+        assert util.range_cache_stats()["hits"] == 6
+
+        await s3mng.delete_upload(ob.file.uri, ob.file._bucket_name)
+        assert util.range_cache_stats()["blocks"] == 0
+    finally:
+        util._block_cache = None
+
+
+async def test_compressed_upload(util, upload_request):
+    upload_request.headers["Accept-Encoding"] = "gzip, deflate"
+    data = b"".join(b'{"id": %d}\n' % idx for idx in range(200000))
+
+    async def generator():
+        for offset in range(0, len(data), CHUNK_SIZE):
+            yield data[offset : offset + CHUNK_SIZE]
+
+    util._compression = Compression(frame_size=256 * 1024)
+    try:
+        ob = create_content()
+        ob.file = None
+        mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+        await mng.save_file(generator, content_type="application/json")
+        assert ob.file.size == len(data)
+        assert ob.file._compression == "gzip"
+
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        assert (await s3mng.stat())["size"] < len(data) / 4
+        assert b"".join([chunk async for chunk in s3mng.iter_data()]) == data
+        chunks = [chunk async for chunk in s3mng.read_range(1000000, 1300000)]
+        assert b"".join(chunks) == data[1000000:1300000]
+        ranges = [(5, 10), (len(data) - 3, len(data))]
+        chunks = [chunk async for chunk in s3mng.read_ranges(ranges)]
+        assert chunks == [data[5:10], data[-3:]]
+
+        assert s3mng.content_encoding() == "gzip"
+        encoded = b"".join([chunk async for chunk in s3mng.iter_data(encoded=True)])
+        assert gzip.decompress(encoded) == data
+
+        new_ob = create_content()
+        new_ob.file = None
+        new_mng = S3FileStorageManager(
+            new_ob, upload_request, IContent["file"].bind(new_ob)
+        )
+        new_dm = DBDataManager(new_mng)
+        await new_dm.load()
+        await s3mng.copy(new_mng, new_dm)
+        assert b"".join([chunk async for chunk in new_mng.iter_data()]) == data
+
+        # other content types are stored as sent
+        await mng.save_file(generator, content_type="image/png")
+        assert ob.file._compression is None
+        assert (await s3mng.stat())["size"] == len(data)
+    finally:
+        util._compression = None
+
+
+async def test_verify_uploads(util, upload_request):
+    data = os.urandom(6 * 1024 * 1024)
+
+    async def generator():
+        for offset in range(0, len(data), 1024 * 1024):
+            yield data[offset : offset + 1024 * 1024]
+
+    client = util._pools["default"].client
+    upload_part = client.upload_part
+    sent = []
+
+    async def corrupted_once(**kwargs):
+        sent.append(kwargs.get("ContentMD5"))
+        response = await upload_part(**kwargs)
+        if len(sent) == 1:
+            # the ETag of a part that was corrupted on the way
+            response["ETag"] = '"' + 32 * "0" + '"'
+        return response
+
+    util._verify_uploads = True
+    client.upload_part = corrupted_once
+    try:
+        ob = create_content()
+        ob.file = None
+        mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+        await mng.save_file(generator, content_type="application/data")
+    finally:
+        util._verify_uploads = False
+        del client.upload_part
+
+    # the first part was sent again
+    assert len(sent) == 3
+    assert all(sent)
+    assert ob.file._sha256 == sha256(data).hexdigest()
+    assert ob.file._etag.endswith('-2"')
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    assert b"".join([chunk async for chunk in s3mng.iter_data()]) == data
+
+
+async def test_request_metrics(util, upload_request):
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        yield 5000 * b"x"
+
+    await mng.save_file(generator, content_type="application/data")
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    async for chunk in s3mng.iter_data():
+        pass
+
+    snapshot = util.metrics_snapshot()
+    for operation in ("put_object", "get_object"):
+        assert snapshot["latency"][operation]["count"] >= 1
+    assert snapshot["queue_wait"]["default"]["count"] >= 2
+    assert snapshot["in_flight"] == 0
+    assert snapshot["bytes_sent"] >= 5000
+    assert snapshot["bytes_received"] >= 5000
+
+
+async def test_download_pool(util, upload_request):
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        yield 5000 * b"x"
+
+    await mng.save_file(generator, content_type="application/data")
+
+    util._pools["download"] = ClientPool(util._s3aioclient, 1)
+    try:
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        async for chunk in s3mng.iter_data():
+            assert chunk == 5000 * b"x"
+    finally:
+        del util._pools["download"]
+    assert util.metrics_snapshot()["queue_wait"]["download"]["count"] == 1
+
+
+async def test_dedup(util, upload_request):
+    util._dedup = True
+    try:
+
+        async def generator():
+            yield 5000 * b"x"
+
+        obs = []
+        for _ in range(2):
+            ob = create_content()
+            ob.file = None
+            mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+            await mng.save_file(generator, content_type="application/data")
+            obs.append(ob)
+        first, second = obs
+        assert first.file.uri == second.file.uri
+        assert first.file._sha256 == second.file._sha256
+        assert first.file._dedup_ref != second.file._dedup_ref
+
+        copied = create_content()
+        copied.file = None
+        s3mng = S3FileStorageManager(
+            first, upload_request, IContent["file"].bind(first)
+        )
+        to_mng = S3FileStorageManager(
+            copied, upload_request, IContent["file"].bind(copied)
+        )
+        to_dm = DBDataManager(to_mng)
+        await to_dm.load()
+        await s3mng.copy(to_mng, to_dm)
+        assert copied.file.uri == first.file.uri
+
+        uri = first.file.uri
+        for ob in obs:
+            await FileManager(ob, upload_request, IContent["file"].bind(ob)).delete()
+            assert uri in [item["Key"] for item in await get_all_objects()]
+
+        await FileManager(
+            copied, upload_request, IContent["file"].bind(copied)
+        ).delete()
+        assert await get_all_objects() == []
+    finally:
+        util._dedup = False
+
+
+async def test_dedup_claim_during_release(util, upload_request):
+    util._dedup = True
+    try:
+
+        async def generator():
+            yield 5000 * b"x"
+
+        ob = create_content()
+        ob.file = None
+        mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+        await mng.save_file(generator, content_type="application/data")
+        file = ob.file
+        bucket = await util.get_bucket_name()
+        pointer = storage._dedup_key(file.uri, file._sha256)
+
+        releaser = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        claimer = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        read, checked = asyncio.Event(), asyncio.Event()
+
+        put_marker = claimer._put_marker
+
+        async def put_marker_after_check(*args, **kwargs):
+            # the pointer was read, reference once the release checked
+            read.set()
+            await checked.wait()
+            await put_marker(*args, **kwargs)
+
+        claimer._put_marker = put_marker_after_check
+        claim = asyncio.ensure_future(claimer._claim_duplicate(bucket, pointer, "new"))
+        await read.wait()
+
+        has_refs = releaser._has_refs
+        calls = []
+
+        async def has_refs_then_claim(*args):
+            result = await has_refs(*args)
+            calls.append(result)
+            if len(calls) == 2:
+                # the claim completes before the release deletes the object
+                checked.set()
+                await claim
+            return result
+
+        releaser._has_refs = has_refs_then_claim
+        await releaser._release(file)
+
+        # the claim backs off, instead of pointing to the deleted object
+        assert calls == [False, False]
+        assert claim.result() is None
+        assert await get_all_objects() == []
+    finally:
+        util._dedup = False
+
+
+async def test_small_file_single_put(util, upload_request):
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        yield 5000 * b"x"
+
+    await mng.save_file(generator, content_type="application/data")
+    latency = util.metrics_snapshot()["latency"]
+    assert latency["put_object"]["count"] == 1
+    assert "create_multipart_upload" not in latency
+    assert ob.file._etag == '"%s"' % md5(5000 * b"x").hexdigest()
+
+    async def large_generator():
+        yield (CHUNK_SIZE + 1) * b"x"
+
+    await mng.save_file(large_generator, content_type="application/data")
+    latency = util.metrics_snapshot()["latency"]
+    assert latency["put_object"]["count"] == 1
+    assert latency["complete_multipart_upload"]["count"] == 1
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == (CHUNK_SIZE + 1) * b"x"
+
+
+async def test_packed_parts(upload_request):
+    ob = create_content()
+    ob.file = None
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    dm = DBDataManager(s3mng)
+    await dm.load()
+    await dm.start()
+    await dm.update(_parts=b"")
+
+    etag = '"%s"' % md5(b"part").hexdigest()
+    await s3mng._register_parts(
+        dm,
+        [
+            {"PartNumber": 1, "ETag": etag},
+            {"PartNumber": 2, "ETag": '"not-an-md5"'},
+        ],
+    )
+    await s3mng._register_parts(dm, [{"PartNumber": 4, "ETag": etag}])
+    assert len(dm.get("_parts")) == 4 * 16
+    assert await s3mng._get_multipart(dm) == {
+        "Parts": [
+            {"PartNumber": 1, "ETag": etag},
+            {"PartNumber": 2, "ETag": '"not-an-md5"'},
+            {"PartNumber": 4, "ETag": etag},
+        ]
+    }
+
+
+async def test_tus_resume_reuses_stored_parts(util, upload_request, reader):
+    file_data = _test_gif
+    while len(file_data) < (11 * 1024 * 1024):
+        file_data += _test_gif
+
+    upload_request.headers.update(
+        {
+            "Content-Type": "image/gif",
+            "UPLOAD-MD5HASH": md5(file_data).hexdigest(),
+            "UPLOAD-EXTENSION": "gif",
+            "UPLOAD-FILENAME": "test.gif",
+            "TUS-RESUMABLE": "1.0.0",
+            "UPLOAD-LENGTH": len(file_data),
+        }
+    )
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    await mng.tus_create()
+
+    chunk = file_data[: 5 * 1024 * 1024]
+    upload_request.headers.update({"Content-Length": len(chunk), "upload-offset": 0})
+    reader.set(chunk)
+    upload_request._cache_data = b""
+    upload_request._last_read_pos = 0
+    await mng.tus_patch()
+
+    # retried after a conflict, the state of the stored part is lost
+    ob.__uploads__["file"]["offset"] = 0
+    ob.__uploads__["file"]["_block"] = 1
+    ob.__uploads__["file"]["_parts"] = b""
+    # the retried request reads the data cached by the first attempt
+    upload_request._last_read_pos = 0
+    upload_request._retry_attempt = 1
+    await mng.tus_patch()
+    upload_request._retry_attempt = 0
+    assert util.metrics_snapshot()["latency"]["upload_part"]["count"] == 1
+    assert util.metrics_snapshot()["latency"]["list_parts"]["count"] == 1
+
+    chunk = file_data[5 * 1024 * 1024 :]
+    upload_request.headers.update(
+        {"Content-Length": len(chunk), "upload-offset": 5 * 1024 * 1024}
+    )
+    reader.set(chunk)
+    upload_request._cache_data = b""
+    upload_request._last_read_pos = 0
+    await mng.tus_patch()
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == file_data
+
+
+async def test_tus_patches_not_part_aligned(util, upload_request, reader):
+    file_data = b""
+    while len(file_data) < (19 * 1024 * 1024):
+        file_data += _test_gif
+
+    upload_request.headers.update(
+        {
+            "Content-Type": "image/gif",
+            "UPLOAD-MD5HASH": md5(file_data).hexdigest(),
+            "UPLOAD-EXTENSION": "gif",
+            "UPLOAD-FILENAME": "test.gif",
+            "TUS-RESUMABLE": "1.0.0",
+            "UPLOAD-LENGTH": len(file_data),
+        }
+    )
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    await mng.tus_create()
+
+    offset = 0
+    for size in (8 * 1024 * 1024, 7 * 1024 * 1024, None):
+        chunk = file_data[offset : offset + size if size else None]
+        upload_request.headers.update(
+            {"Content-Length": len(chunk), "upload-offset": offset}
+        )
+        reader.set(chunk)
+        upload_request._cache_data = b""
+        upload_request._last_read_pos = 0
+        await mng.tus_patch()
+        offset += len(chunk)
+
+    # one part per patch, the tail of each patch is not a part of its own
+    assert util.metrics_snapshot()["latency"]["upload_part"]["count"] == 3
+    # stored parts are only listed when a request is retried
+    assert "list_parts" not in util.metrics_snapshot()["latency"]
+    assert ob.file._size == len(file_data)
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == file_data
+
+
+async def test_retry_budget_of_file_bucket(util, upload_request):
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        yield b"x" * 1024
+
+    await mng.save_file(generator, content_type="application/data")
+    # files stored before the bucket was recorded
+    ob.file._bucket_name = None
+
+    buckets = []
+    call = util._retry_policy.call
+
+    async def record_call(func, args, kwargs, bucket=None):
+        buckets.append(bucket)
+        return await call(func, args, kwargs, bucket=bucket)
+
+    util._retry_policy.call = record_call
+    try:
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        assert b"".join([chunk async for chunk in s3mng.iter_data()]) == b"x" * 1024
+        assert await s3mng.exists()
+    finally:
+        del util._retry_policy.call
+    assert buckets and None not in buckets
@@ -31,7 +31,6 @@ setup(
         "ujson",
         "aiobotocore==0.9.4",
         "botocore==1.10.58",
-        "backoff",
     ],
     extras_require={
         "test": [
@@ -39,6 +38,9 @@ setup(
             "pytest-aiohttp",
             "pytest-docker-fixtures",
             "async_asgi_testclient",
-        ]
+            "backoff",
+        ],
+        "prometheus": ["prometheus_client"],
+        "zstd": ["zstandard"],
     },
 )